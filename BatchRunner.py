@@ -0,0 +1,271 @@
+# Author: Casey Betts, 2024
+# Headless batch runner for the revs listed in a json config file, runs without ArcPro on the native engine
+#
+#   python BatchRunner.py config.json
+#   python BatchRunner.py --check        reports whether importing the runner loaded arcpy
+#
+# {
+#   "engine": "native",                  "native" (numpy, pandas and shapely only) or "arcgis" (Clear_Order_Value)
+#   "backend": "shapely",                overlay backend, "shapely" or "tiled" natively, any Clear_Order_Value backend
+#   "workspace": "/data/csi/out",        output folder (native) or .gdb (arcgis)
+#   "inputs": {"orders": "orders.parquet", "onv": "onv.gpkg", "weather": "clouds.npz", "inventory": "inventory.parquet"},
+#   "revs": [51234, 51235],              every rev of the ONV when left out
+#   "clear_mode": "vector", "workers": null, "top_k": 20, "output_format": "parquet", "metrics": "metrics.jsonl",
+#   "strip_mode": "ranked",              arcgis "grid" (GridIndexFeatures) or "ranked", the native engine always ranks
+#   "strip_width_km": 15, "strip_length_km": 60,
+#   "cell_size": null                    arcgis "value_raster" resolution in degrees, the weather grid when null
+# }
+#
+# Native inputs are GeoPackage layers, Parquet files with WKB "geometry" columns (GeoParquet) or csv files with
+# WKT ones, and the weather is a saved CloudMask (.npz) or a .npy raster with its .npy.json grid. Relative paths
+# are relative to the config file. arcpy is only imported when the "arcgis" engine is selected.
+
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import traceback
+
+from contextlib import closing
+
+import numpy as np
+import pandas as pd
+import shapely
+
+from ClearValueRaster import open_value_raster
+from CloudMask import CloudMask
+from CollectionMetrics import collection_metrics
+from Geodesy import polygon_areas
+from Instrumentation import configure, instrument, tagged
+from OnaAccess import accessible_orders
+from OrderOverlay import csi_value, sum_overlay
+from StripRanking import top_strips
+from Tiling import tiled_sum_overlay
+
+# Size of the envelope following the 8 byte GeoPackage geometry header, by envelope indicator
+GPKG_ENVELOPE_BYTES = (0, 32, 48, 48, 64)
+
+
+def load_config(path):
+    """ Returns the config with its input paths made absolute """
+
+    with open(path) as f:
+        config = json.load(f)
+
+    folder = os.path.dirname(os.path.abspath(path))
+    config["inputs"] = {name: os.path.join(folder, value) for name, value in config.get("inputs", {}).items()}
+    config["workspace"] = os.path.join(folder, config.get("workspace", "."))
+
+    return config
+
+def gpkg_geometries(blobs):
+    """ Returns shapely geometries from GeoPackage geometry blobs """
+
+    def wkb(blob):
+        return bytes(blob[8 + GPKG_ENVELOPE_BYTES[(blob[3] >> 1) & 0b111]:])
+
+    return shapely.from_wkb([None if blob is None else wkb(blob) for blob in blobs])
+
+def read_gpkg(path, layer=None):
+    """ Returns a dataframe of a GeoPackage layer (the only one if not given) with its geometry as "geometry" """
+
+    with closing(sqlite3.connect(path)) as connection:
+
+        if layer is None:
+            layers = [name for name, in connection.execute("SELECT table_name FROM gpkg_contents")]
+            if len(layers) != 1:
+                raise ValueError(f"'{path}' has layers {layers}, name one as path|layer")
+            layer = layers[0]
+
+        geometry_columns = [name for name, in connection.execute("SELECT column_name FROM gpkg_geometry_columns WHERE table_name = ?", (layer,))]
+        df = pd.read_sql_query(f'SELECT * FROM "{layer}"', connection)
+
+    for column in geometry_columns:
+        df[column] = gpkg_geometries(df[column].values)
+
+    return df.rename(columns={column: "geometry" for column in geometry_columns})
+
+def read_table(path):
+    """ Returns a dataframe of a GeoPackage layer ("path.gpkg|layer"), Parquet or csv file, with shapely geometries
+    in its "geometry" column if it has one """
+
+    path, _, layer = path.partition("|")
+    extension = os.path.splitext(path)[1].lower()
+
+    if extension == ".gpkg":
+        return read_gpkg(path, layer or None)
+
+    if extension == ".parquet":
+        df = pd.read_parquet(path)
+        if "geometry" in df:
+            df["geometry"] = shapely.from_wkb(df["geometry"].values)
+        return df
+
+    if extension == ".csv":
+        df = pd.read_csv(path)
+        if "geometry" in df:
+            df["geometry"] = shapely.from_wkt(df["geometry"].values)
+        return df
+
+    raise ValueError(f"Unknown input format '{extension}' of '{path}'.")
+
+def read_cloud_mask(path, nodata=0):
+    """ Returns the CloudMask saved at path, or encoded from a .npy weather raster and its grid """
+
+    if path.endswith(".npz"):
+        return CloudMask.load(path)
+
+    weather, grid = open_value_raster(path)
+
+    return CloudMask.from_array(weather, grid, nodata)
+
+def write_table(df, folder, name, output_format="parquet"):
+    """ Writes the dataframe, geometry as WKB in parquet and WKT in csv, and returns the path """
+
+    path = os.path.join(folder, name + "." + output_format)
+
+    if output_format == "parquet":
+        df.assign(**({"geometry": shapely.to_wkb(df["geometry"].values)} if "geometry" in df else {})).to_parquet(path, index=False)
+
+    elif output_format == "csv":
+        df.assign(**({"geometry": shapely.to_wkt(df["geometry"].values)} if "geometry" in df else {})).to_csv(path, index=False)
+
+    else:
+        raise ValueError(f"Unknown output format '{output_format}'.")
+
+    return path
+
+@instrument(inputs=lambda orders, *args, **kwargs: {"orders_features": len(orders)})
+def run_native_rev(orders, onv, mask, metrics, rev, config):
+    """ Runs the pipeline for one rev with the native engines, writes its clear order faces and top strips and
+    returns a summary of the rev """
+
+    output_format = config.get("output_format", "parquet")
+
+    # ONV bands of the rev today
+    bands = onv[(onv["rev_num"].astype(str) == rev) & (onv["days"] == 0)]
+    if not len(bands):
+        return {"rev": rev, "status": "no_bands", "orders": 0, "faces": 0, "area_km2": 0.0, "dollar_value": 0.0}
+
+    footprint = shapely.union_all(bands["geometry"].values)
+
+    # Orders the rev can access, valued as the CSI_Value field
+    keep, access_ona = accessible_orders(orders["geometry"].values, orders["max_ona"].values, bands["geometry"].values,
+                                         bands["ona"].values, config.get("respect_ona", True))
+    geometries = orders["geometry"].values[keep]
+    values = csi_value(orders["tasking_priority"].values[keep])
+
+    # Sum overlapping order values
+    if config.get("backend", "shapely") == "tiled":
+        faces, sums, counts, _ = tiled_sum_overlay(geometries, values, footprint, config.get("n_tiles") or os.cpu_count(), config.get("workers"))
+    else:
+        faces, sums, counts = sum_overlay(geometries, values)
+
+    # Clear part of each face from the day's cloud mask clipped to the rev
+    clear_fraction = 1 - mask.clip(footprint).cloud_fraction(faces)
+    clear_km2 = polygon_areas(faces) * clear_fraction
+
+    clear_orders = pd.DataFrame({"geometry": faces, "Join_Count": counts, "CSI_Value": sums,
+                                 "clear_fraction": clear_fraction, "area_km2": clear_km2, "dollar_value": clear_km2 * sums})
+    clear_orders = clear_orders[clear_orders["area_km2"] > 0]
+    write_table(clear_orders, config["workspace"], "CSI_" + rev + "_clear_orders", output_format)
+
+    # Best strips along the track
+    strips = top_strips(faces, sums * clear_fraction, footprint, config.get("top_k", 20), config.get("strip_width_km", 15), config.get("strip_length_km", 60))
+    write_table(pd.DataFrame({"geometry": [strip for _, strip in strips], "strip_rank": np.arange(1, len(strips) + 1),
+                              "clear_value": [value for value, _ in strips]}),
+                config["workspace"], "CSI_" + rev + "_top_strips", output_format)
+
+    summary = {"rev": rev, "status": "ok", "orders": int(keep.sum()), "faces": len(faces), "area_km2": float(clear_km2.sum()),
+               "dollar_value": float(clear_orders["dollar_value"].sum())}
+    if rev in metrics.index:
+        summary.update(metrics.loc[rev].to_dict())
+
+    return summary
+
+def run_native(config):
+    """ Runs every rev of the config with the native engines and returns a dataframe summarizing each rev """
+
+    inputs = config["inputs"]
+    os.makedirs(config["workspace"], exist_ok=True)
+
+    # Every input is read once for all the revs
+    orders, onv = read_table(inputs["orders"]), read_table(inputs["onv"])
+    mask = read_cloud_mask(inputs["weather"])
+
+    if "inventory" in inputs:
+        inventory = read_table(inputs["inventory"]).dropna(subset=["acquisition_rev_number", "cc"])
+        metrics = collection_metrics(inventory["acquisition_rev_number"].astype("int64").astype(str), inventory["cc"].values)
+    else:
+        metrics = pd.DataFrame()
+
+    revs = [str(rev) for rev in config.get("revs") or sorted(onv.loc[onv["days"] == 0, "rev_num"].unique())]
+
+    summaries = []
+    for rev in revs:
+        with tagged(rev=rev, backend=config.get("backend", "shapely"), engine="native"):
+            try:
+                summaries.append(run_native_rev(orders, onv, mask, metrics, rev, config))
+            except Exception:
+                # Contain the failure to this rev
+                summaries.append({"rev": rev, "status": "failed", "error": traceback.format_exc()})
+
+    summary = pd.DataFrame(summaries)
+    summary.to_csv(os.path.join(config["workspace"], "summary.csv"), index=False)
+
+    return summary
+
+def run_arcgis(config):
+    """ Runs every rev of the config with the ArcPro tool functions, importing arcpy only now """
+
+    import arcpy
+
+    from Clear_Order_Value import run, run_revs, workspace_cache
+    from CreateRevFC import find_revs
+
+    inputs = config["inputs"]
+    prod, onv, weather, inventory = (inputs[name] for name in ("orders", "onv", "weather", "inventory"))
+    backend, clear_mode = config.get("backend", "arcpy"), config.get("clear_mode", "vector")
+    options = {"strip_mode": config.get("strip_mode", "grid"), "top_k": config.get("top_k", 20),
+              "strip_width_km": config.get("strip_width_km", 15), "strip_length_km": config.get("strip_length_km", 60),
+              "cell_size": config.get("cell_size")}
+
+    arcpy.env.overwriteOutput = True
+    revs = [str(rev) for rev in config.get("revs") or sorted(find_revs(onv))]
+
+    if config.get("workers"):
+        return run_revs(prod, onv, weather, inventory, revs, backend, clear_mode, config["workers"], config.get("scratch_folder"), **options)
+
+    cache = workspace_cache(config["workspace"]) if config.get("cache") else None
+    for rev in revs:
+        run(prod, onv, weather, inventory, rev, backend, clear_mode, config["workspace"], cache, **options)
+
+    return pd.DataFrame({"rev": revs})
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description="Run the Clear Sky Insight pipeline for the revs of a config file")
+    parser.add_argument("config", nargs="?", help="json config file")
+    parser.add_argument("--check", action="store_true", help="report whether arcpy was imported and exit")
+    args = parser.parse_args(argv)
+
+    if args.check or args.config is None:
+        print(json.dumps({"arcpy_imported": "arcpy" in sys.modules}))
+        return
+
+    config = load_config(args.config)
+
+    if config.get("metrics"):
+        configure(path=os.path.join(os.path.dirname(os.path.abspath(args.config)), config["metrics"]))
+
+    if config.get("engine", "native") == "arcgis":
+        summary = run_arcgis(config)
+    else:
+        summary = run_native(config)
+
+    print(summary.to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,309 @@
+# Author: Casey Betts, 2024
+# Benchmarks of the pipeline stages on synthetic orders, ONV revs and cloud rasters, runs without ArcPro
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import shapely
+
+from datetime import datetime
+from time import perf_counter
+
+from ClearValueRaster import Grid, clear_value_by_order
+from CloudMask import CloudMask
+from CollectionMetrics import collection_metrics
+from Geodesy import get_distance, get_distances, polygon_areas
+from OnaAccess import accessible_orders
+from OrderBounds import bbox_dimensions, bbox_index, join_bboxes
+from OrderOverlay import csi_value, sum_overlay
+from StripRanking import top_strips
+
+# Kilometers per degree of latitude
+KM_PER_DEGREE = 111.2
+
+
+def synthetic_bboxes(n, seed=0):
+    """ Returns a dataframe of n random order bounding boxes in degrees """
+
+    rng = np.random.default_rng(seed)
+
+    x_min = rng.uniform(-180, 179, n)
+    y_min = rng.uniform(-80, 79, n)
+
+    return pd.DataFrame({"x_min": x_min,
+                         "x_max": x_min + rng.uniform(0, 1, n),
+                         "y_min": y_min,
+                         "y_max": y_min + rng.uniform(0, 1, n)})
+
+def benchmark_dimensions(n=10000, seed=0):
+    """ Times the per-row width calculation against the vectorized width and height calculation """
+
+    df = synthetic_bboxes(n, seed)
+
+    # Per-row path (width only, as the dataframe was originally populated)
+    start = perf_counter()
+    df.apply(lambda p: get_distance((p.y_min, p.x_min), (p.y_min, p.x_max)), axis=1)
+    per_row = perf_counter() - start
+
+    # Vectorized path (width and height)
+    start = perf_counter()
+    get_distances(df.y_min, df.x_min, df.y_min, df.x_max)
+    get_distances(df.y_min, df.x_min, df.y_max, df.x_min)
+    vectorized = perf_counter() - start
+
+    return {"rows": n,
+            "per_row_seconds": per_row,
+            "vectorized_seconds": vectorized,
+            "speedup": per_row / vectorized}
+
+def benchmark_areas(n=300000, seed=0):
+    """ Times the spherical area of n small sliver polygons like the ones the cloud erase leaves """
+
+    rng = np.random.default_rng(seed)
+    x, y = rng.uniform(-180, 179, n), rng.uniform(-70, 70, n)
+    slivers = shapely.box(x, y, x + rng.uniform(1e-5, 1e-2, n), y + rng.uniform(1e-5, 1e-2, n))
+
+    start = perf_counter()
+    areas = polygon_areas(slivers)
+
+    return {"polygons": n, "seconds": perf_counter() - start, "area_km2": float(areas.sum())}
+
+def benchmark_cold_start(runs=5):
+    """ Times starting the headless batch runner on the native path in a new interpreter, which must stay under a
+    second, and checks that it never imports arcpy """
+
+    runner = os.path.join(os.path.dirname(os.path.abspath(__file__)), "BatchRunner.py")
+    seconds = []
+
+    for _ in range(runs):
+        start = perf_counter()
+        result = subprocess.run([sys.executable, runner, "--check"], capture_output=True, text=True, check=True)
+        seconds.append(perf_counter() - start)
+
+    return {"runs": runs, "best_seconds": min(seconds), "median_seconds": float(np.median(seconds)), **json.loads(result.stdout)}
+
+def write_synthetic_geojson(path, n, seed=0):
+    """ Writes a FeatureCollection of n random rectangular orders with a FeaturesToJSON style property table """
+
+    rng = np.random.default_rng(seed)
+
+    with open(path, "w") as f:
+        f.write('{"type": "FeatureCollection", "features": [\n')
+
+        for i, (x, y, w, h) in enumerate(zip(rng.uniform(-180, 179, n), rng.uniform(-80, 79, n), rng.uniform(0, 1, n), rng.uniform(0, 1, n))):
+            feature = {"type": "Feature",
+                       "properties": {"external_i": f"order_{i}", "tasking_pr": 750, "sap_custom": "customer", "order_desc": "synthetic order"},
+                       "geometry": {"type": "Polygon", "coordinates": [[[x, y], [x + w, y], [x + w, y + h], [x, y + h], [x, y]]]}}
+            f.write(("" if i == 0 else ",\n") + json.dumps(feature))
+
+        f.write("\n]}")
+
+def benchmark_geojson_memory(n=1000000, seed=0, compare_json_load=False):
+    """ Measures the peak python heap of building the bounding box table from a synthetic GeoJSON file by streaming,
+    and optionally by json.load of the whole file """
+
+    path = os.path.join(tempfile.mkdtemp(), "out.geojson")
+    write_synthetic_geojson(path, n, seed)
+    result = {"features": n, "file_mb": os.path.getsize(path) / 2 ** 20}
+
+    # Streaming path
+    tracemalloc.start()
+    start = perf_counter()
+    bbox_index(path)
+    result["stream_seconds"] = perf_counter() - start
+    result["stream_peak_mb"] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+    tracemalloc.stop()
+
+    # Whole file path
+    if compare_json_load:
+        tracemalloc.start()
+        start = perf_counter()
+        with open(path) as f:
+            geodata = json.load(f)
+        rows = [(feature["properties"]["external_i"],) for feature in geodata["features"]]
+        result["load_seconds"] = perf_counter() - start
+        result["load_peak_mb"] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        result["load_features"] = len(rows)
+        tracemalloc.stop()
+
+    os.remove(path)
+
+    return result
+
+def synthetic_rev(seed=0, length_deg=100, onas=(15, 20, 25, 30, 35, 45), altitude_km=617):
+    """ Returns (band polygons, band ONA values, ground track) of a synthetic rev: a north bound track with one band
+    per ONA reaching out to the cross track distance of that ONA on each side, narrowest first """
+
+    rng = np.random.default_rng(seed)
+
+    lon0 = rng.uniform(-150, 150)
+    lat = np.linspace(-length_deg / 2, length_deg / 2, 200)
+    track = shapely.linestrings(lon0 + 0.2 * lat, lat)
+
+    # Each band covers the ground between the previous ONA's reach and its own, in degrees at the equator
+    reach = [altitude_km * np.tan(np.radians(ona)) / KM_PER_DEGREE for ona in onas]
+    bands, inner = [], None
+
+    for ona, distance in zip(onas, reach):
+        outer = shapely.buffer(track, distance, cap_style="flat")
+        bands.append(outer if inner is None else shapely.difference(outer, inner))
+        inner = outer
+
+    return np.array(bands, dtype=object), np.array(onas), track
+
+def synthetic_orders(n, track, seed=0, hotspots=200, spread_deg=0.5):
+    """ Returns a dataframe of n synthetic orders clustered around hotspots near the ground track with geometry,
+    tasking_priority and max_ona columns, overlapping about as densely as a PROD deck over populated areas """
+
+    rng = np.random.default_rng(seed)
+
+    # Hotspots along and beside the track, orders scattered around them
+    centers = shapely.get_coordinates(shapely.line_interpolate_point(track, rng.uniform(0, 1, hotspots), normalized=True))
+    centers[:, 0] += rng.uniform(-5, 5, hotspots)
+    hotspot = rng.integers(0, hotspots, n)
+
+    x = centers[hotspot, 0] + rng.normal(0, spread_deg, n)
+    y = np.clip(centers[hotspot, 1] + rng.normal(0, spread_deg, n), -85, 85)
+
+    # 5 to 30 km orders
+    width = rng.uniform(5, 30, n) / (KM_PER_DEGREE * np.cos(np.radians(y)))
+    height = rng.uniform(5, 30, n) / KM_PER_DEGREE
+
+    return pd.DataFrame({"external_i": [f"order_{i}" for i in range(n)],
+                         "geometry": shapely.box(x, y, x + width, y + height),
+                         "tasking_priority": rng.integers(700, 800, n),
+                         "max_ona": rng.choice([15, 20, 25, 30, 35, 45], n)})
+
+def synthetic_clouds(grid, cloud_fraction=0.4, seed=0, feature_cells=40):
+    """ Returns a uint8 weather array for the grid where cloud_fraction of the cells are cloudy (non zero) in
+    blobs about feature_cells across """
+
+    rng = np.random.default_rng(seed)
+
+    # Smooth noise made by upsampling coarse noise and blurring it
+    coarse = rng.normal(size=(grid.rows // feature_cells + 2, grid.cols // feature_cells + 2))
+    field = np.kron(coarse, np.ones((feature_cells, feature_cells)))[:grid.rows, :grid.cols]
+    for axis in (0, 1):
+        field = sum(np.roll(field, shift, axis) for shift in range(-feature_cells // 2, feature_cells // 2)) / feature_cells
+
+    threshold = np.quantile(field, 1 - cloud_fraction)
+
+    return np.where(field > threshold, rng.integers(1, 101, field.shape), 0).astype("uint8")
+
+def timed(report, stage, func, *args, **kwargs):
+    """ Runs func, records its wall time in the report under the stage name and returns its result """
+
+    start = perf_counter()
+    result = func(*args, **kwargs)
+    report["stages"][stage] = perf_counter() - start
+
+    return result
+
+def benchmark_pipeline(n_orders, cloud_fraction=0.4, cell_deg=0.05, top_k=20, n_collects=None, seed=0):
+    """ Times each stage of the pipeline on synthetic inputs of the given scale and returns a report dict """
+
+    report = {"orders": n_orders, "cloud_fraction": cloud_fraction, "cell_deg": cell_deg, "seed": seed, "stages": {}}
+
+    bands, onas, track = synthetic_rev(seed)
+    deck = synthetic_orders(n_orders, track, seed)
+
+    # Select the orders the rev can access
+    keep, access_ona = timed(report, "available_orders", accessible_orders, deck.geometry.values, deck.max_ona.values, bands, onas)
+    orders = deck[keep]
+    report["available_orders_count"] = len(orders)
+
+    # Sum the values of overlapping orders
+    values = csi_value(orders.tasking_priority.values)
+    faces, sums, counts = timed(report, "order_overlay", sum_overlay, orders.geometry.values, values)
+    report["faces"] = len(faces)
+
+    # Cloud mask of the weather raster over the rev
+    footprint = shapely.union_all(bands)
+    x_min, y_min, x_max, y_max = footprint.bounds
+    grid = Grid(x_min, y_max, cell_deg, cell_deg, int(np.ceil((y_max - y_min) / cell_deg)), int(np.ceil((x_max - x_min) / cell_deg)))
+    weather = synthetic_clouds(grid, cloud_fraction, seed)
+    mask = timed(report, "cloud_mask", CloudMask.from_windows, grid, lambda r, c, nr, nc: weather[r:r + nr, c:c + nc])
+    report["raster_pixels"] = weather.size
+    report["cloud_runs"] = len(mask.rows)
+    report["cloudy_pixels"] = int((mask.stops - mask.starts).sum())
+
+    # Cloudy area of every face from the mask clipped to the rev
+    clipped = timed(report, "cloud_clip", mask.clip, footprint)
+    _, cloudy_km2 = timed(report, "cloud_areas", clipped.areas, faces)
+    report["cloudy_km2"] = float(cloudy_km2.sum())
+
+    # Remove the cloudy area from the value surface (raster zonal sums stand in for Erase without ArcPro)
+    clear = timed(report, "erase", clear_value_by_order, faces, sums, grid, lambda r, c, nr, nc: weather[r:r + nr, c:c + nc])
+    report["clear_value"] = float(clear.clear_value.sum())
+
+    # Area and dollar value of every face
+    areas = timed(report, "dollar_values", polygon_areas, faces)
+    report["face_dollar_value"] = float((areas * sums).sum())
+
+    # Score strips over the clear value surface, weighting each face by its clear fraction
+    clear_fraction = np.divide(clear.clear_km2, clear.area_km2, out=np.zeros(len(clear)), where=clear.area_km2 > 0)
+    timed(report, "strip_scoring", top_strips, faces, sums * clear_fraction, footprint, top_k)
+
+    # Orders table bounding boxes and dimensions from a GeoJSON export
+    path = os.path.join(tempfile.mkdtemp(), "out.geojson")
+    with open(path, "w") as f:
+        json.dump({"type": "FeatureCollection",
+                   "features": [{"type": "Feature", "properties": {"external_i": order}, "geometry": json.loads(shapely.to_geojson(geometry))}
+                                for order, geometry in zip(orders.external_i, orders.geometry)]}, f)
+    timed(report, "orders_bbox_dimensions", orders_bbox_dimensions, orders.external_i.values, path)
+    os.remove(path)
+
+    # Collection metrics over an inventory of collects on many revs
+    rng = np.random.default_rng(seed)
+    n_collects = n_collects or n_orders
+    timed(report, "collection_metrix", collection_metrics, rng.integers(0, 500, n_collects), rng.uniform(0, 100, n_collects))
+
+    return report
+
+def orders_bbox_dimensions(external_ids, path):
+    """ Returns the bounding box and width and height table the Orders class builds from a GeoJSON export """
+
+    df = join_bboxes(external_ids, bbox_index(path))
+    df["width"], df["height"] = bbox_dimensions(df)
+
+    return df
+
+def run_suite(scales, output, cloud_fraction=0.4, seed=0):
+    """ Runs the pipeline benchmark at each scale and appends one json line per scale to the output file """
+
+    environment = {"python": sys.version.split()[0], "platform": platform.platform(), "numpy": np.__version__,
+                   "pandas": pd.__version__, "shapely": shapely.__version__, "date": datetime.now().isoformat(timespec="seconds")}
+
+    with open(output, "a") as f:
+        for n in scales:
+            report = benchmark_pipeline(n, cloud_fraction, seed=seed)
+            report.update(environment)
+            f.write(json.dumps(report) + "\n")
+            print(json.dumps(report["stages"]))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark the Clear Sky Insight pipeline on synthetic data")
+    parser.add_argument("--scales", type=int, nargs="+", default=[1000, 10000, 100000], help="numbers of orders to benchmark")
+    parser.add_argument("--cloud-fraction", type=float, default=0.4)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="bench_output.txt", help="json lines report, one line per scale")
+    parser.add_argument("--micro", action="store_true", help="also run the dimension, area, cold start and GeoJSON memory micro-benchmarks")
+    args = parser.parse_args()
+
+    run_suite(args.scales, args.output, args.cloud_fraction, args.seed)
+
+    if args.micro:
+        print(benchmark_dimensions())
+        print(benchmark_areas())
+        print(benchmark_cold_start())
+        print(benchmark_geojson_memory(compare_json_load=True))
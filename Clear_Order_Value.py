@@ -4,6 +4,40 @@
 # File will require a PROD active orders layer and a today's ONV layer to run
 
 import arcpy
+import asyncio
+import multiprocessing
+import numpy as np
+import os
+import pandas as pd
+import shapely
+import sys
+import tempfile
+import traceback
+
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+
+from CloudMask import CloudMask
+from ClearValueRaster import Grid, burn_values, clear_surface_value, clear_value_by_order, open_value_raster, resampled_reader, write_value_raster
+from CollectionMetrics import CC_BINS, CLEAR_THRESHOLD, collection_metrics
+from Geodesy import polygon_areas
+from OnaAccess import accessible_orders
+from OrderOverlay import deck_keys, sum_overlay, update_overlay
+from StageCache import StageCache, file_fingerprint, fingerprint, rows_fingerprint
+from Instrumentation import feature_count, input_counts, instrument, output_counts, pixel_count, tagged
+from StripRanking import top_strips
+from Tiling import tiled_sum_overlay
+from ValueService import ValueService
+from WeatherStack import build_stack, value_over_time
+
+# Path to the geodatabase, CSI_WORKSPACE points the tools at another one
+WORKSPACE = os.environ.get("CSI_WORKSPACE", r"C:\Users\ca003927\OneDrive - Maxar Technologies Holdings Inc\Private Drop\Git\Clear_Sky_Insight\CSI_GeoDatabase.gdb\\")
+
+# Counts for the stage records
+def cloud_counts(rev_clouds):
+    """ Returns the cloud polygon count and the pixel count of the clipped weather raster they came from """
+
+    return {"output_features": feature_count(rev_clouds), "raster_pixels": pixel_count(rev_clouds.replace("_clouds", "_weather_raster"))}
 
 def ms_export(layer, location, name):
     """ Exports the given layer to the given location with the given identifier appended to the given name """
@@ -13,6 +47,7 @@ def ms_export(layer, location, name):
     arcpy.management.MultipartToSinglepart(layer, out_file)
 
 # Create a strip overlay of the order layer with Grid Index Features
+@instrument(inputs=input_counts(orders=0), outputs=output_counts)
 def create_strip_overlay(orders_layer, rev):
     """ Creates a .gdb layer containing a strip overlay of the given layer """
     
@@ -21,6 +56,32 @@ def create_strip_overlay(orders_layer, rev):
         
     return "CSI_" + rev + "_strips"
 
+# Rank strips by the clear order value they cover
+@instrument(inputs=input_counts(orders=0), outputs=output_counts)
+def rank_strips(clear_layer, onv_rev, rev, k=20, width_km=15, length_km=60):
+    """ Creates a .gdb layer of the k strips along the rev's ground track covering the most clear order value """
+
+    arcpy.AddMessage("Running rank_strips.....")
+
+    out_layer = "CSI_" + rev + "_top_strips"
+
+    faces, values = read_order_values(clear_layer)
+    strips = top_strips(faces, values, read_footprint(onv_rev), k, width_km, length_km)
+
+    # Write the strips with their rank and value
+    spatial_reference = arcpy.Describe(clear_layer).spatialReference
+    arcpy.management.CreateFeatureclass(arcpy.env.workspace, out_layer, "POLYGON", spatial_reference=spatial_reference)
+    arcpy.management.AddField(out_layer, "strip_rank", "SHORT")
+    arcpy.management.AddField(out_layer, "clear_value", "DOUBLE")
+
+    with arcpy.da.InsertCursor(out_layer, ["SHAPE@", "strip_rank", "clear_value"]) as cursor:
+        for rank, (value, strip) in enumerate(strips, 1):
+            cursor.insertRow([arcpy.FromWKB(shapely.to_wkb(strip), spatial_reference), rank, float(value)])
+
+    arcpy.AddMessage("\b Done")
+
+    return out_layer
+
 # Create point feature from layer
 def create_point_feature(orders_layer, out_feature_class):
     """ Given an order layer and output location this creates a point featuer at the center of each order """
@@ -40,6 +101,7 @@ def weather_over_orders(weather_raster, orders_layer, output_location):
                           "NO_MAINTAIN_EXTENT")
 
 # Select available orders
+@instrument(inputs=input_counts(prod=0), outputs=output_counts)
 def available_orders(prod, onv, rev, respect_ona = True):
     """ Select orders accessable on a given rev based on the order's max ONA vlaue """
 
@@ -49,53 +111,188 @@ def available_orders(prod, onv, rev, respect_ona = True):
     onv_rev = "CSI_" + rev + "_onv"
     prod_layer = "CSI_" + rev + "_PROD"
 
-    # Definition query values
-    onv_values = [35, 30, 25, 20, 15]
-
     # Select and export the given rev
     selection = f"\"rev_num\" = {rev} And days = 0"
     arcpy.conversion.ExportFeatures(onv, onv_rev, selection)
 
-    # Select orders intersecting the 45deg segments of the rev (max selection)
-    arcpy.management.SelectLayerByLocation(prod, "INTERSECT", onv_rev, None, "NEW_SELECTION")
+    # Read the ONA bands of the rev in the orders' coordinate system, as SelectLayerByLocation projected on the fly
+    spatial_reference = arcpy.Describe(prod).spatialReference
+    with arcpy.da.SearchCursor(onv_rev, ["SHAPE@WKB", "ona"], spatial_reference=spatial_reference) as cursor:
+        bands = [(bytes(wkb), ona) for wkb, ona in cursor]
+
+    # Read only the id, shape and max ONA of every order of the deck
+    arcpy.management.SelectLayerByAttribute(prod, "CLEAR_SELECTION")
+    with arcpy.da.SearchCursor(prod, ["OID@", "SHAPE@WKB", "max_ona"]) as cursor:
+        deck = [(oid, bytes(wkb), max_ona) for oid, wkb, max_ona in cursor]
+    oids, wkbs, max_onas = zip(*deck) if deck else ((), (), ())
+
+    # Classify every order against every band in one pass of a spatial index
+    band_wkbs, band_onas = zip(*bands) if bands else ((), ())
+    geometries = shapely.from_wkb(list(wkbs))
+    keep, access_ona = accessible_orders(geometries, list(max_onas), shapely.from_wkb(list(band_wkbs)), list(band_onas), respect_ona)
+    kept = {oids[i]: i for i in np.flatnonzero(keep)}
+
+    # Write the accessible orders one part per feature (as MultipartToSinglepart did) with the lowest ONA band each
+    # is accessible at so later stages need not select again, a rev with no accessible orders gets an empty layer
+    fields = [field.name for field in arcpy.ListFields(prod)
+              if field.editable and field.type not in ("OID", "Geometry") and field.name not in ("ORIG_FID", "access_ona")]
+
+    arcpy.management.CreateFeatureclass(arcpy.env.workspace, prod_layer, "POLYGON", prod, spatial_reference=spatial_reference)
+    template_fields = [field.name for field in arcpy.ListFields(prod_layer)]
+    for field, field_type in [("ORIG_FID", "LONG"), ("access_ona", "SHORT")]:
+        if field not in template_fields:
+            arcpy.management.AddField(prod_layer, field, field_type)
+
+    # The attributes are streamed from a second read and only those of the kept orders are used
+    with arcpy.da.SearchCursor(prod, ["OID@"] + fields) as rows, arcpy.da.InsertCursor(prod_layer, ["SHAPE@", "ORIG_FID", "access_ona"] + fields) as cursor:
+        for oid, *attributes in rows:
+            if oid not in kept:
+                continue
+            i = kept[oid]
+            for part in shapely.to_wkb(shapely.get_parts(geometries[i])):
+                cursor.insertRow([arcpy.FromWKB(part, spatial_reference), oid, int(access_ona[i])] + attributes)
 
-    # Only include orders that are avaialble based on their max ONA value
-    if respect_ona:
+    arcpy.AddMessage("\b Done")
 
-        for ona in onv_values:
+    return prod_layer
 
-            # Deselect orders with ONA under current value
-            arcpy.management.SelectLayerByAttribute(prod, "REMOVE_FROM_SELECTION", "max_ona < " + str(ona + 1), None)
+# Read order geometry for the native engines
+def read_order_values(order_layer):
+    """ Returns the shapely polygons and CSI values of the given order layer in cursor order """
 
-            # Create an onv feature
-            feature_layer = arcpy.management.MakeFeatureLayer(onv_rev, "FeatureLayer", f"ona = {ona}")
+    wkbs, values = [], []
 
-            # Select orders intersecting the current onv feature layer
-            arcpy.management.SelectLayerByLocation(prod, "INTERSECT", feature_layer, None, "ADD_TO_SELECTION")
+    # Read the order polygons and their values
+    with arcpy.da.SearchCursor(order_layer, ["SHAPE@WKB", "CSI_Value"]) as cursor:
+        for wkb, value in cursor:
+            wkbs.append(bytes(wkb))
+            values.append(value)
 
-    # Export the order layer (strip overlay does not seem to work without an exported feature)
-    arcpy.management.MultipartToSinglepart(prod, prod_layer)
+    return shapely.from_wkb(wkbs), values
 
-    arcpy.AddMessage("\b Done")
+# Read the rev footprint
+def read_footprint(onv_rev):
+    """ Returns the union of the ONV bands of a rev as a shapely geometry """
 
-    return prod_layer
+    with arcpy.da.SearchCursor(onv_rev, ["SHAPE@WKB"]) as cursor:
+        return shapely.union_all(shapely.from_wkb([bytes(wkb) for wkb, in cursor]))
+
+# Read one attribute of a layer
+def read_field(layer, field):
+    """ Returns the values of the given field of the layer in cursor order """
+
+    with arcpy.da.SearchCursor(layer, [field]) as cursor:
+        return [value for value, in cursor]
+
+# Sum overlapping order values without the FeatureToPolygon and SpatialJoin tools
+def overlay_order_values(order_layer, out_layer, onv_rev=None, n_tiles=None):
+    """ Writes the faces of the overlapping orders with their summed CSI value using the shapely overlay engine,
+    split into n_tiles along track tiles of the rev processed in parallel if the rev's ONV layer is given """
+
+    geometries, values = read_order_values(order_layer)
+
+    if onv_rev is None:
+        faces, sums, counts = sum_overlay(geometries, values)
+    else:
+        set_worker_executable()
+        faces, sums, counts, _ = tiled_sum_overlay(geometries, values, read_footprint(onv_rev), n_tiles or os.cpu_count())
+
+    # Create the output feature class with the same fields the spatial join produces
+    spatial_reference = arcpy.Describe(order_layer).spatialReference
+    arcpy.management.CreateFeatureclass(arcpy.env.workspace, out_layer, "POLYGON", spatial_reference=spatial_reference)
+    arcpy.management.AddField(out_layer, "Join_Count", "LONG")
+    arcpy.management.AddField(out_layer, "CSI_Value", "DOUBLE")
+
+    insert_faces(out_layer, faces, sums, counts, spatial_reference)
+
+# Write value surface faces
+def insert_faces(out_layer, faces, sums, counts, spatial_reference):
+    """ Inserts the given faces with their join count and summed CSI value into the given layer """
+
+    with arcpy.da.InsertCursor(out_layer, ["SHAPE@", "Join_Count", "CSI_Value"]) as cursor:
+        for face, count, value in zip(shapely.to_wkb(faces), counts, sums):
+            cursor.insertRow([arcpy.FromWKB(face, spatial_reference), int(count), float(value)])
+
+# Splice the changed part of the deck into the stored value surface
+def update_order_values(order_layer, previous_layer, surface_layer):
+    """ Updates the stored value surface of the rev for the orders added, cancelled or re-prioritized since the
+    previous order layer, recomputing only the area those orders cover """
+
+    # Key every order of both decks on its id, geometry and value
+    old_geometries, old_values = read_order_values(previous_layer)
+    new_geometries, new_values = read_order_values(order_layer)
+    old_keys = deck_keys(read_field(previous_layer, "external_i"), old_geometries, old_values)
+    new_keys = deck_keys(read_field(order_layer, "external_i"), new_geometries, new_values)
+
+    oids, wkbs, sums, counts = [], [], [], []
+
+    # Read the stored surface
+    with arcpy.da.SearchCursor(surface_layer, ["OID@", "SHAPE@WKB", "CSI_Value", "Join_Count"]) as cursor:
+        for oid, wkb, value, count in cursor:
+            oids.append(oid)
+            wkbs.append(bytes(wkb))
+            sums.append(value)
+            counts.append(count)
+
+    stale, faces, new_sums, new_counts = update_overlay(shapely.from_wkb(wkbs), sums, counts,
+                                                        old_geometries, old_keys, new_geometries, new_values, new_keys)
+
+    arcpy.AddMessage(f"Replacing {len(stale)} of {len(oids)} faces with {len(faces)}")
+
+    # Delete the stale faces and insert their replacements
+    stale_oids = {oids[i] for i in stale}
+    with arcpy.da.UpdateCursor(surface_layer, ["OID@"]) as cursor:
+        for oid, in cursor:
+            if oid in stale_oids:
+                cursor.deleteRow()
+
+    insert_faces(surface_layer, faces, new_sums, new_counts, arcpy.Describe(surface_layer).spatialReference)
+
+# Create the available order layer with values
+def create_value_layer(prod, onv, rev):
+    """ Creates the feature class of orders available on the rev with the CSI value of each order """
+
+    # Create feature class of available orders under the rev and get the name of that file
+    order_layer = available_orders(prod, onv, rev)    
+
+    # Add a field to the order layer and calculate the CSI value
+    arcpy.management.CalculateField(order_layer, "CSI_Value", "(100-(!tasking_priority!-700))**1.5", "PYTHON3", '', "LONG", "NO_ENFORCE_DOMAINS")
+
+    return order_layer
 
 # Create order layers
-def create_order_layers(prod, onv, rev):
-    """ Creates the Base order layer, the feature_to_polygon layer, and the spatial join layer """
+@instrument(outputs=output_counts)
+def create_order_layers(prod, onv, rev, backend="arcpy"):
+    """ Creates the Base order layer, the feature_to_polygon layer, and the spatial join layer,
+    backend is "arcpy", "shapely", "tiled" (shapely on along track tiles in parallel) or "incremental" (update the
+    rev's stored spatial join layer in place) """
 
     arcpy.AddMessage("Running create_order_layers.....")
 
     # Layer names
     FtP_layer = "CSI_" + rev + "_FtP"
     spatial_join_layer = "CSI_" + rev + "_SJ"
+    deck_layer = spatial_join_layer + "_deck"
 
-    # Create feature class of available orders under the rev and get the name of that file
-    order_layer = available_orders(prod, onv, rev)    
+    # The new deck is diffed against the orders the spatial join layer was last built or updated from, the PROD layer
+    # may have been rewritten since by the other clear modes or the weather stack
+    incremental = backend == "incremental" and arcpy.Exists(deck_layer) and arcpy.Exists(spatial_join_layer)
+
+    # Create feature class of available orders under the rev with their values
+    order_layer = create_value_layer(prod, onv, rev)
+
+    if incremental:
+        update_order_values(order_layer, deck_layer, spatial_join_layer)
+
+    # Use the native overlay engine in place of the ArcPro geoprocessing tools (also the first incremental run)
+    elif backend in ("shapely", "incremental", "tiled"):
+        overlay_order_values(order_layer, spatial_join_layer, "CSI_" + rev + "_onv" if backend == "tiled" else None)
+
+    if backend in ("shapely", "incremental", "tiled"):
+        arcpy.management.CopyFeatures(order_layer, deck_layer)
+        arcpy.AddMessage("\b Done")
+        return spatial_join_layer
 
-    # Add a field to the order layer and calculate the CSI value
-    arcpy.management.CalculateField(order_layer, "CSI_Value", "(100-(!tasking_priority!-700))**1.5", "PYTHON3", '', "LONG", "NO_ENFORCE_DOMAINS")
-    
     # Create a feature to polygon layer
     arcpy.management.FeatureToPolygon(order_layer, 
                                       FtP_layer, 
@@ -112,20 +309,20 @@ def create_order_layers(prod, onv, rev):
                                'FID_PROD_76429 "FID_PROD_76429" true true false 4 Long 0 0,First,#,PROD_76429,CSI_Value,-1,-1;CSI_Value "CSI_Value" true true false 8 Double 0 0,Sum,#,PROD_76429,CSI_Value,-1,-1;', "HAVE_THEIR_CENTER_IN", 
                                None, 
                                '')
+
+    # Snapshot of the deck the spatial join layer was built from
+    arcpy.management.CopyFeatures(order_layer, deck_layer)
     
     arcpy.AddMessage("\b Done")
     
     return spatial_join_layer
 
-# Create weather shapefile
-def create_cloud_shape(onv, weather, rev):
-    """ Creates a shapefile of the areas on a given rev that have cloud cover """
-
-    arcpy.AddMessage("Running create_cloud_shape.....")
+# Clip the weather raster to the rev
+def clip_weather(onv, weather, rev):
+    """ Creates a raster of the weather file clipped to the given rev """
 
     # Layer name
     rev_raster = "CSI_" + rev + "_weather_raster"
-    rev_clouds = "CSI_" + rev + "_clouds"
 
     # Clip weather raster to rev
     arcpy.management.Clip(weather, 
@@ -135,8 +332,21 @@ def create_cloud_shape(onv, weather, rev):
                           "0", 
                           "ClippingGeometry", 
                           "NO_MAINTAIN_EXTENT")
-    
-    
+
+    return rev_raster
+
+# Create weather shapefile
+@instrument(outputs=cloud_counts)
+def create_cloud_shape(onv, weather, rev):
+    """ Creates a shapefile of the areas on a given rev that have cloud cover """
+
+    arcpy.AddMessage("Running create_cloud_shape.....")
+
+    # Layer name
+    rev_clouds = "CSI_" + rev + "_clouds"
+
+    # Clip weather raster to rev
+    rev_raster = clip_weather(onv, weather, rev)
     
     # Create a polygon from the weather raster
     with arcpy.EnvManager(outputZFlag="Disabled", outputMFlag="Disabled"):
@@ -151,6 +361,148 @@ def create_cloud_shape(onv, weather, rev):
         
     return rev_clouds
         
+# Read the weather raster a window at a time
+def raster_grid(raster):
+    """ Returns the Grid of the given raster and a function reading a window of it into a numpy array """
+
+    raster = arcpy.Raster(raster)
+    extent = raster.extent
+    grid = Grid(extent.XMin, extent.YMax, raster.meanCellWidth, raster.meanCellHeight, raster.height, raster.width)
+
+    def read_window(row, col, nrows, ncols):
+        x_min, y_min, _, _ = grid.window_bounds(row, col, nrows, ncols)
+        return arcpy.RasterToNumPyArray(raster, arcpy.Point(x_min, y_min), ncols, nrows, 0)
+
+    return grid, read_window
+
+# Clear value from the weather raster without creating cloud polygons
+@instrument(inputs=lambda order_layer, rev_raster: {"orders_features": feature_count(order_layer), "raster_pixels": pixel_count(rev_raster)})
+def clear_value_raster(order_layer, rev_raster):
+    """ Writes the clear area and clear dollar value of each order to the order layer and returns the rev total """
+
+    arcpy.AddMessage("Running clear_value_raster.....")
+
+    geometries, values = read_order_values(order_layer)
+    grid, read_window = raster_grid(rev_raster)
+    order_values = clear_value_by_order(geometries, values, grid, read_window)
+
+    # Write the results back to the orders in cursor order (the fields exist when the order layer came from the cache)
+    fields = [field.name for field in arcpy.ListFields(order_layer)]
+    for field in ["clear_km2", "clear_value"]:
+        if field not in fields:
+            arcpy.management.AddField(order_layer, field, "DOUBLE")
+
+    with arcpy.da.UpdateCursor(order_layer, ["clear_km2", "clear_value"]) as cursor:
+        for row, result in zip(cursor, order_values.itertuples()):
+            cursor.updateRow([result.clear_km2, result.clear_value])
+
+    arcpy.AddMessage("\b Done")
+
+    return order_values.clear_value.sum()
+
+# Cloud mask of a day's weather
+@instrument(inputs=lambda weather, *args: {"raster_pixels": pixel_count(weather)}, outputs=lambda mask: {"cloud_runs": len(mask.rows)})
+def weather_cloud_mask(weather, folder):
+    """ Returns the run length encoded CloudMask of a weather raster, computed once and saved in the folder so every
+    rev and metric of the day reuses it """
+
+    path = os.path.join(folder, "CSI_clouds_" + dataset_fingerprint(weather)[:16] + ".npz")
+
+    if os.path.exists(path):
+        return CloudMask.load(path)
+
+    grid, read_window = raster_grid(weather)
+    mask = CloudMask.from_windows(grid, read_window)
+    mask.save(path)
+
+    return mask
+
+# Clear value from the cloud mask
+@instrument(inputs=input_counts(orders=0))
+def clear_value_mask(order_layer, mask):
+    """ Writes the clear area and clear dollar value of each order to the order layer and returns the rev total """
+
+    arcpy.AddMessage("Running clear_value_mask.....")
+
+    geometries, values = read_order_values(order_layer)
+    area, cloudy = mask.areas(geometries)
+    clear_km2 = area - cloudy
+    clear_value = clear_km2 * np.asarray(values, dtype="float64")
+
+    fields = [field.name for field in arcpy.ListFields(order_layer)]
+    for field in ["clear_km2", "clear_value"]:
+        if field not in fields:
+            arcpy.management.AddField(order_layer, field, "DOUBLE")
+
+    with arcpy.da.UpdateCursor(order_layer, ["clear_km2", "clear_value"]) as cursor:
+        for row, km2, value in zip(cursor, clear_km2, clear_value):
+            cursor.updateRow([float(km2), float(value)])
+
+    arcpy.AddMessage("\b Done")
+
+    return float(clear_value.sum())
+
+# Value raster of the rev
+@instrument(inputs=lambda order_layer, rev_raster, *args: {"orders_features": feature_count(order_layer), "raster_pixels": pixel_count(rev_raster)})
+def create_value_raster(order_layer, rev_raster, rev, folder, grid=None):
+    """ Creates a float32 .npy (memory mappable) and GeoTIFF raster of the dollar value on each pixel of the given
+    grid (the rev's weather grid by default) and returns the .npy path """
+
+    arcpy.AddMessage("Running create_value_raster.....")
+
+    grid = grid or raster_grid(rev_raster)[0]
+    path = os.path.join(folder, "CSI_" + rev + "_value.npy")
+
+    geometries, values = read_order_values(order_layer)
+    surface = write_value_raster(path, geometries, values, grid)
+
+    # GeoTIFF copy for viewing in ArcPro
+    lower_left = arcpy.Point(grid.left, grid.top - grid.rows * grid.cell_height)
+    value_raster = arcpy.NumPyArrayToRaster(np.asarray(surface), lower_left, grid.cell_width, grid.cell_height)
+    arcpy.management.DefineProjection(value_raster, arcpy.Describe(rev_raster).spatialReference)
+    value_raster.save(os.path.join(folder, "CSI_" + rev + "_value.tif"))
+
+    arcpy.AddMessage("\b Done")
+
+    return path
+
+# Clear value of the rev under many weather rasters
+@instrument()
+def weather_stack_values(prod, onv, weathers, rev, labels=None, workspace=WORKSPACE, scratch_folder=None):
+    """ Returns a table of the rev's clear order value under each of the given weather rasters (hourly analyses or
+    ensemble members), computing the order values once for every raster """
+
+    arcpy.AddMessage("Running weather_stack_values.....")
+
+    # Path to the geodatabase
+    arcpy.env.workspace = workspace
+
+    # Order values are burned onto the weather grid once and reused for every raster
+    order_layer = create_value_layer(prod, onv, rev)
+    onv_rev = "CSI_" + rev + "_onv"
+
+    # Clip every raster to the rev aligned to the grid of the first one
+    rasters = []
+    for t, weather in enumerate(weathers):
+        env = {"snapRaster": rasters[0], "cellSize": rasters[0], "extent": rasters[0]} if rasters else {}
+        with arcpy.EnvManager(**env):
+            rasters.append(clip_weather(onv_rev, weather, rev + "_t" + str(t)))
+
+    grid, _ = raster_grid(rasters[0])
+    lower_left = arcpy.Point(grid.left, grid.top - grid.rows * grid.cell_height)
+
+    # Stack the rasters in a memory map, one raster in memory at a time
+    path = os.path.join(scratch_folder or tempfile.mkdtemp(prefix="CSI_"), "CSI_" + rev + "_weather_stack.npy")
+    stack = build_stack(path, grid, (arcpy.RasterToNumPyArray(raster, lower_left, grid.cols, grid.rows, 0) for raster in rasters), len(rasters))
+
+    geometries, values = read_order_values(order_layer)
+    table = value_over_time(burn_values(geometries, values, grid), stack, labels, rev)
+
+    arcpy.AddMessage(table)
+    arcpy.AddMessage("\b Done")
+
+    return table
+
 def add_layers_to_map(layer1):
     """ Will add the desired layers to the map and symbolize them """
 
@@ -179,97 +531,366 @@ def add_layers_to_map(layer1):
 
     arcpy.AddMessage("\b Done")
 
+# Cut the clouds out of the value surface
+@instrument(inputs=input_counts(orders=0, clouds=1), outputs=output_counts)
+def erase_clouds(sj_layer, cloud_layer, clear_layer):
+    """ Creates the layer of the value surface in clear areas only """
+
+    arcpy.analysis.Erase(sj_layer, cloud_layer, clear_layer, None)
+
+    return clear_layer
+
+# Dollar value of every clear piece
+@instrument(inputs=input_counts(clear_faces=0))
+def add_dollar_values(clear_layer, totals_table, rev):
+    """ Adds the area_km2 and dollar_value (area times summed CSI value) of every face to the clear layer, writes
+    the rev's totals to a one row table and returns them """
+
+    arcpy.AddMessage("Running add_dollar_values.....")
+
+    faces, values = read_order_values(clear_layer)
+    areas = polygon_areas(faces)
+    dollars = areas * np.asarray(values, dtype="float64")
+
+    for field in ("area_km2", "dollar_value"):
+        if field not in [f.name for f in arcpy.ListFields(clear_layer)]:
+            arcpy.management.AddField(clear_layer, field, "DOUBLE")
+
+    # Same layer, same cursor order as the read
+    with arcpy.da.UpdateCursor(clear_layer, ["area_km2", "dollar_value"]) as cursor:
+        for row, area, dollar in zip(cursor, areas, dollars):
+            cursor.updateRow([float(area), float(dollar)])
+
+    # Totals of the rev
+    totals = {"rev": rev, "faces": len(faces), "area_km2": float(areas.sum()), "dollar_value": float(dollars.sum())}
+    arcpy.management.CreateTable(arcpy.env.workspace, totals_table)
+    arcpy.management.AddField(totals_table, "rev", "TEXT")
+    arcpy.management.AddField(totals_table, "faces", "LONG")
+    arcpy.management.AddField(totals_table, "area_km2", "DOUBLE")
+    arcpy.management.AddField(totals_table, "dollar_value", "DOUBLE")
+
+    with arcpy.da.InsertCursor(totals_table, list(totals)) as cursor:
+        cursor.insertRow(list(totals.values()))
+
+    arcpy.AddMessage("Clear value of rev " + rev + ": " + str(totals["dollar_value"]))
+    arcpy.AddMessage("\b Done")
+
+    return totals
+
+# Fingerprint an input dataset for the stage cache
+def dataset_fingerprint(data):
+    """ Returns a fingerprint of the given dataset from its file, or the content of every row of a table or feature
+    class (geometry included), or its path and extent """
+
+    describe = arcpy.Describe(data)
+    path = describe.catalogPath
+
+    if os.path.isfile(path):
+        return file_fingerprint(path)
+
+    # Orders re-prioritized or reshaped in place keep their count and extent, only their content tells
+    if hasattr(describe, "fields"):
+        fields = ["OID@"] + [field.name for field in describe.fields if field.type not in ("OID", "Geometry", "Blob", "Raster")]
+        fields += ["SHAPE@WKB"] if hasattr(describe, "shapeType") else []
+
+        with arcpy.da.SearchCursor(data, fields) as cursor:
+            return fingerprint(path, rows_fingerprint(cursor))
+
+    return fingerprint(path, str(getattr(describe, "extent", "")))
+
+# Cheap change token of a dataset for polling
+def dataset_version(data):
+    """ Returns a token that changes when the given table or feature class is rewritten, from its row count, largest
+    object id and the newest modification time of the files of its geodatabase, without reading its rows """
+
+    describe = arcpy.Describe(data)
+    path = describe.catalogPath
+
+    with arcpy.da.SearchCursor(data, ["OID@"], sql_clause=(None, f"ORDER BY {describe.OIDFieldName} DESC")) as cursor:
+        max_oid = next(iter(cursor), (None,))[0]
+
+    # The tables of a file geodatabase are files inside its folder
+    folder = os.path.dirname(path)
+    files = [os.path.join(folder, name) for name in os.listdir(folder)] if folder.lower().endswith(".gdb") else [path]
+    mtime = max((os.stat(file).st_mtime_ns for file in files if os.path.isfile(file)), default=None)
+
+    return fingerprint(path, feature_count(data), max_oid, mtime)
+
+# Run a stage through the cache when one is given
+def cached_stage(cache, name, outputs, inputs, func):
+    """ Runs func, skipping it if the cache holds outputs made from the same inputs, and returns the stage key """
+
+    if cache is None:
+        func()
+        return None
+
+    return cache.stage(name, outputs, inputs, func)
+
+# Create the stage cache for a workspace
+def workspace_cache(workspace=WORKSPACE, max_entries=64):
+    """ Returns a StageCache for the given geodatabase with its catalog saved next to it """
+
+    catalog_path = os.path.splitext(workspace.rstrip("\\/"))[0] + "_cache.json"
+
+    return StageCache(catalog_path, arcpy.Exists, arcpy.management.Delete, max_entries, arcpy.AddMessage)
+
 # Create feature classes for orders, weather and strips
-def create_feature_classes(prod, onv, weather, rev):
-    """ Runs all the functions needed to produce the feature classes"""
+@instrument()
+def create_feature_classes(prod, onv, weather, rev, backend="arcpy", clear_mode="vector", workspace=WORKSPACE, add_to_map=True, cache=None,
+                           strip_mode="grid", top_k=20, cell_size=None, strip_width_km=15, strip_length_km=60):
+    """ Runs all the functions needed to produce the feature classes and returns the name of the final layer,
+    clear_mode is "vector", "raster" (per order zonal sums), "mask" (per order sums on the day's run length encoded
+    cloud mask) or "value_raster" (a value surface at cell_size degrees, the weather grid by default), strip_mode is "grid" (GridIndexFeatures) or "ranked" (top_k strips by value),
+    ranked strips are strip_width_km by strip_length_km, stages already in the given StageCache are skipped """
 
     arcpy.AddMessage("Running create_feature_classes.....")
 
     # Path to the geodatabase
-    arcpy.env.workspace = r"C:\Users\ca003927\OneDrive - Maxar Technologies Holdings Inc\Private Drop\Git\Clear_Sky_Insight\CSI_GeoDatabase.gdb\\"
+    arcpy.env.workspace = workspace
+
+    # Layer names
+    onv_rev = "CSI_" + rev + "_onv"
+    order_layer = "CSI_" + rev + "_PROD"
+    sj_layer = "CSI_" + rev + "_SJ"
+    cloud_layer = "CSI_" + rev + "_clouds"
+    clear_layer = "CSI_" + rev + "_clear_orders"
+
+    # Fingerprint the inputs once, a stage's key is then passed on to the stages using its outputs
+    if cache is not None:
+        prod_key, onv_key, weather_key = (dataset_fingerprint(data) for data in (prod, onv, weather))
+    else:
+        prod_key = onv_key = weather_key = None
+
+    # Sum the clear value on the weather grid instead of erasing cloud polygons from the order overlay
+    if clear_mode == "raster":
+        cached_stage(cache, order_layer, [onv_rev, order_layer], {"prod": prod_key, "onv": onv_key, "rev": rev},
+                     lambda: create_value_layer(prod, onv, rev))
+        rev_value = clear_value_raster(order_layer, clip_weather(onv_rev, weather, rev))
+        arcpy.AddMessage("Clear value of rev " + rev + ": " + str(rev_value))
+        arcpy.AddMessage("\b Done")
+        return order_layer
+
+    # Intersect the orders with the day's cloud mask clipped to the rev
+    if clear_mode == "mask":
+        cached_stage(cache, order_layer, [onv_rev, order_layer], {"prod": prod_key, "onv": onv_key, "rev": rev},
+                     lambda: create_value_layer(prod, onv, rev))
+        folder = os.path.dirname(workspace.rstrip("\\/"))
+        mask = weather_cloud_mask(weather, folder).clip(read_footprint(onv_rev))
+        mask.save(os.path.join(folder, "CSI_" + rev + "_clouds.npz"))
+        rev_value = clear_value_mask(order_layer, mask)
+        arcpy.AddMessage("Clear value of rev " + rev + ": " + str(rev_value))
+        arcpy.AddMessage("\b Done")
+        return order_layer
+
+    # Burn the order values into a value raster and sum it where the weather is clear
+    if clear_mode == "value_raster":
+        cached_stage(cache, order_layer, [onv_rev, order_layer], {"prod": prod_key, "onv": onv_key, "rev": rev},
+                     lambda: create_value_layer(prod, onv, rev))
+        rev_raster = clip_weather(onv_rev, weather, rev)
+        weather_grid, read_weather = raster_grid(rev_raster)
+
+        # A surface at cell_size degrees over the clipped weather reads the weather under each of its pixel centers
+        if cell_size:
+            grid = Grid.from_bounds(*weather_grid.window_bounds(0, 0, weather_grid.rows, weather_grid.cols), cell_size)
+            read_weather = resampled_reader(grid, weather_grid, read_weather)
+        else:
+            grid = weather_grid
+
+        surface_path = create_value_raster(order_layer, rev_raster, rev, os.path.dirname(workspace.rstrip("\\/")), grid)
+        surface, grid = open_value_raster(surface_path)
+        rev_value = clear_surface_value(surface, grid, read_weather)
+        arcpy.AddMessage("Clear value of rev " + rev + ": " + str(rev_value))
+        arcpy.AddMessage("\b Done")
+        return surface_path
 
     # Create order layers
-    sj_layer = create_order_layers(prod, onv, rev)
+    order_outputs = [onv_rev, order_layer, sj_layer, sj_layer + "_deck"] + (["CSI_" + rev + "_FtP"] if backend == "arcpy" else [])
+    order_key = cached_stage(cache, sj_layer, order_outputs, {"prod": prod_key, "onv": onv_key, "rev": rev, "backend": backend},
+                             lambda: create_order_layers(prod, onv, rev, backend))
 
     # Create cloud shape
-    cloud_layer = create_cloud_shape("CSI_" + rev + "_onv", weather, rev)
+    cloud_key = cached_stage(cache, cloud_layer, ["CSI_" + rev + "_weather_raster", cloud_layer], {"weather": weather_key, "onv": onv_key, "rev": rev},
+                             lambda: create_cloud_shape(onv_rev, weather, rev))
      
     # Create order layer in clear areas only
-    add_layers_to_map(arcpy.analysis.Erase(sj_layer, cloud_layer, "CSI_" + rev + "_clear_orders", None))
+    clear_key = cached_stage(cache, clear_layer, [clear_layer], {"orders": order_key, "clouds": cloud_key},
+                             lambda: erase_clouds(sj_layer, cloud_layer, clear_layer))
 
-    # Create an overlay of strip sized polygons
-    strip_layer = create_strip_overlay("CSI_" + rev + "_clear_orders", rev)
+    # Area and dollar value of every clear piece and the totals of the rev
+    cached_stage(cache, "CSI_" + rev + "_totals", ["CSI_" + rev + "_totals"], {"clear_orders": clear_key},
+                 lambda: add_dollar_values(clear_layer, "CSI_" + rev + "_totals", rev))
+
+    if add_to_map:
+        add_layers_to_map(os.path.join(workspace, clear_layer))
+
+    # Create an overlay of strip sized polygons, or only the best strips along the track
+    if strip_mode == "ranked":
+        cached_stage(cache, "CSI_" + rev + "_top_strips", ["CSI_" + rev + "_top_strips"],
+                     {"clear_orders": clear_key, "k": top_k, "width_km": strip_width_km, "length_km": strip_length_km},
+                     lambda: rank_strips(clear_layer, onv_rev, rev, top_k, strip_width_km, strip_length_km))
+    else:
+        cached_stage(cache, "CSI_" + rev + "_strips", ["CSI_" + rev + "_strips"], {"clear_orders": clear_key},
+                     lambda: create_strip_overlay(clear_layer, rev))
 
     arcpy.AddMessage("\b Done")
 
+    return clear_layer
+
+# Collection metrics for every rev of the inventory
+def inventory_metrics(inventory, bins=CC_BINS, clear_threshold=CLEAR_THRESHOLD):
+    """ Returns a table of collection metrics for every rev in the inventory from a single read of its attributes """
+
+    # Read the two columns needed in one scan, collects without a cloud cover value are left out
+    table = arcpy.da.TableToNumPyArray(inventory, ["acquisition_rev_number", "cc"], skip_nulls=True)
+
+    return collection_metrics(table["acquisition_rev_number"], table["cc"], bins, clear_threshold)
+
 # Count clear collects
-def collection_metrix(inventory, weather, rev):
-    """ Return a dictionary of values based on the inventory layer for a given rev """
+@instrument()
+def collection_metrix(inventory, rev, workspace=WORKSPACE):
+    """ Return a one row table of collection metrics based on the inventory layer for a given rev """
 
     arcpy.AddMessage("collection_metrix.....")
 
     # Path to the geodatabase
-    arcpy.env.workspace = r"C:\Users\ca003927\OneDrive - Maxar Technologies Holdings Inc\Private Drop\Git\Clear_Sky_Insight\CSI_GeoDatabase.gdb\\"
+    arcpy.env.workspace = workspace
 
     # Set the feature layer name
     rev_collects = "CSI_" + rev + "_collects"
-    collects_raster = "CSI_" + rev + "_collects_raster"
-    collects_clouds = "CSI_" + rev + "_collects_clouds"
 
     # Select and export the collects on the given rev
     selection = f"\"acquisition_rev_number\" = {rev}"
     arcpy.conversion.ExportFeatures(inventory, rev_collects, selection)
 
-    # Create a query to select rows where "weather" < 15
-    clear_query = f"\"cc\" < 15 AND \"acquisition_rev_number\" = {rev}"
-    cloudy_query = f"\"cc\" > 15 AND \"acquisition_rev_number\" = {rev}"
+    # The exported collects of the rev are all the metrics need to read
+    metrics = inventory_metrics(rev_collects)
 
-    # Create a cursor to iterate through the selected rows
-    with arcpy.da.SearchCursor(inventory, ["OID@"], clear_query) as cursor:
-        # Count the number of selected rows
-        clear_count = sum(1 for _ in cursor)
-
-    # Create a cursor to iterate through the selected rows
-    with arcpy.da.SearchCursor(inventory, ["OID@"], cloudy_query) as cursor:
-        # Count the number of selected rows
-        cloudy_count = sum(1 for _ in cursor)
-
-
-    # Clip weather raster to rev
-    arcpy.management.Clip(weather, 
-                          "-180 -90 180 90", 
-                          collects_raster, 
-                          inventory, 
-                          "0", 
-                          "ClippingGeometry", 
-                          "NO_MAINTAIN_EXTENT")
-    
-    # Create a polygon from the weather raster
-    with arcpy.EnvManager(outputZFlag="Disabled", outputMFlag="Disabled"):
-        arcpy.conversion.RasterToPolygon(collects_raster, 
-                                         collects_clouds, 
-                                         "SIMPLIFY", 
-                                         "Value", 
-                                         "SINGLE_OUTER_PART", 
-                                         None)
-        
     arcpy.AddMessage("\b Done") 
         
-    return {"Number of clear collects: ": str(clear_count), 
-            "Number of cloudy collects: ": str(cloudy_count)}
+    return metrics
 
 # Function to be called by the Clear Order Value tool
-def run(prod, onv, weather, inventory, rev):
-    """ This function controls what is run by the tool """
+@instrument()
+def run(prod, onv, weather, inventory, rev, backend="arcpy", clear_mode="vector", workspace=WORKSPACE, cache=None,
+        strip_mode="grid", top_k=20, strip_width_km=15, strip_length_km=60, cell_size=None):
+    """ This function controls what is run by the tool, backend is "arcpy", "shapely", "tiled" or "incremental" for the order overlay,
+    strip_mode "ranked" keeps the top_k strips of strip_width_km by strip_length_km, cell_size is the value_raster resolution in degrees """
     
     # Path to the geodatabase
-    arcpy.env.workspace = r"C:\Users\ca003927\OneDrive - Maxar Technologies Holdings Inc\Private Drop\Git\Clear_Sky_Insight\CSI_GeoDatabase.gdb\\"
+    arcpy.env.workspace = workspace
+
+    # Every stage record of the run is tagged with the rev
+    with tagged(rev=rev, backend=backend, clear_mode=clear_mode):
+
+        # Create all the layers and add to the geodatabase
+        create_feature_classes(prod, onv, weather, rev, backend, clear_mode, workspace, cache=cache, strip_mode=strip_mode, top_k=top_k,
+                               cell_size=cell_size, strip_width_km=strip_width_km, strip_length_km=strip_length_km)
+
+        arcpy.AddMessage( collection_metrix(inventory, rev, workspace) )
+
+# Clear value layers of a rev for the query service
+def read_rev_values(rev, workspace=WORKSPACE):
+    """ Returns the clear faces and values and the orders, values and ids of a rev from the geodatabase """
+
+    faces, values = read_order_values(os.path.join(workspace, "CSI_" + rev + "_clear_orders"))
+    order_layer = os.path.join(workspace, "CSI_" + rev + "_PROD")
+    orders, order_values = read_order_values(order_layer)
+
+    return faces, values, orders, order_values, read_field(order_layer, "external_i")
+
+# Serve clear value queries
+def serve_values(revs=None, workspace=WORKSPACE, host="127.0.0.1", port=8765, path=None, poll_seconds=30):
+    """ Serves footprint value and top order queries over the given revs, or every rev with a clear order layer in
+    the workspace, reloading a rev when its layers are rewritten """
+
+    # Polled for every rev every poll_seconds, so only counts and file times are read, not the rows
+    def version(rev):
+        return fingerprint(*(dataset_version(os.path.join(workspace, "CSI_" + rev + suffix)) for suffix in ("_clear_orders", "_PROD")))
+
+    def list_revs():
+        arcpy.env.workspace = workspace
+        return [name[len("CSI_"):-len("_clear_orders")] for name in arcpy.ListFeatureClasses("CSI_*_clear_orders")]
+
+    service = ValueService(lambda rev: read_rev_values(rev, workspace), version, list_revs, revs, poll_seconds, arcpy.AddMessage)
+
+    asyncio.run(service.serve(host, port, path))
+
+# Start worker processes with python
+def set_worker_executable():
+    """ Points multiprocessing at the python interpreter, inside ArcPro sys.executable is the application """
+
+    if os.name == "nt":
+        multiprocessing.set_executable(os.path.join(sys.exec_prefix, "python.exe"))
+
+# Run a single rev in its own scratch geodatabase
+def run_rev_worker(prod, onv, weather, rev, backend, clear_mode, scratch_folder, strip_mode="grid", top_k=20, strip_width_km=15, strip_length_km=60,
+                   cell_size=None):
+    """ Runs the pipeline for one rev in an isolated workspace and returns a summary of the run """
+
+    start = perf_counter()
+    summary = {"rev": rev, "status": "ok", "workspace": None, "output": None, "seconds": None, "error": None}
+
+    try:
+        # A new worker process starts with overwriteOutput off, a rerun in the same scratch folder replaces the
+        # rev's geodatabase and its layers
+        arcpy.env.overwriteOutput = True
+
+        # Each rev gets its own geodatabase so output names never collide between workers
+        workspace = str(arcpy.management.CreateFileGDB(scratch_folder, "CSI_" + rev + ".gdb"))
+        arcpy.env.workspace = workspace
+        summary["workspace"] = workspace
+
+        # Partition the ONV and the orders down to this rev before running the pipeline
+        onv_slice = arcpy.conversion.ExportFeatures(onv, "onv_" + rev, f"\"rev_num\" = {rev}")
+        orders_layer = arcpy.management.MakeFeatureLayer(prod, "all_orders_" + rev)
+        arcpy.management.SelectLayerByLocation(orders_layer, "INTERSECT", onv_slice, None, "NEW_SELECTION")
+        prod_slice = arcpy.conversion.ExportFeatures(orders_layer, "orders_" + rev)
+        prod_slice_layer = arcpy.management.MakeFeatureLayer(prod_slice, "orders_" + rev + "_layer")
+
+        with tagged(rev=rev, backend=backend, clear_mode=clear_mode):
+            summary["output"] = create_feature_classes(prod_slice_layer, onv_slice, weather, rev, backend, clear_mode, workspace, add_to_map=False,
+                                                       strip_mode=strip_mode, top_k=top_k, cell_size=cell_size, strip_width_km=strip_width_km,
+                                                       strip_length_km=strip_length_km)
+
+    except Exception:
+        # Contain the failure to this rev
+        summary["status"] = "failed"
+        summary["error"] = traceback.format_exc()
+
+    summary["seconds"] = perf_counter() - start
+
+    return summary
+
+# Run many revs at once
+def run_revs(prod, onv, weather, inventory, revs, backend="arcpy", clear_mode="vector", workers=None, scratch_folder=None,
+             strip_mode="grid", top_k=20, strip_width_km=15, strip_length_km=60, cell_size=None):
+    """ Runs the pipeline for each of the given revs in a process pool and returns a dataframe summarizing every rev
+    with its collection metrics """
+
+    # Workers need data paths, layer objects in the current map cannot be sent to another process
+    prod, onv, weather, inventory = (arcpy.Describe(data).catalogPath for data in (prod, onv, weather, inventory))
+    scratch_folder = scratch_folder or tempfile.mkdtemp(prefix="CSI_")
+
+    set_worker_executable()
 
-    # Create all the layers and add to the geodatabase
-    create_feature_classes(prod, onv, weather, rev)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(run_rev_worker, prod, onv, weather, str(rev), backend, clear_mode, scratch_folder,
+                                   strip_mode, top_k, strip_width_km, strip_length_km, cell_size): str(rev)
+                   for rev in revs}
 
-    arcpy.AddMessage( collection_metrix(inventory, weather, rev) )
+        summaries = []
+        for future, rev in futures.items():
+            try:
+                summaries.append(future.result())
+            except Exception:
+                # A worker process that died takes only its own rev with it
+                summaries.append({"rev": rev, "status": "failed", "error": traceback.format_exc()})
 
+    # Collection metrics of every rev from a single read of the inventory
+    metrics = inventory_metrics(inventory)
+    metrics.index = metrics.index.astype("int64").astype(str)
 
+    summary = pd.DataFrame(summaries).join(metrics, on="rev")
+    arcpy.AddMessage(summary.loc[:, ["rev", "status", "seconds"]])
 
- 
+    return summary
@@ -0,0 +1,185 @@
+# Author: Casey Betts, 2024
+# Run length encoded cloud mask on the weather grid, in place of cloud polygons from RasterToPolygon
+#
+# The mask keeps, for every row of the grid, the column intervals [start, stop) of cloudy pixels, so its size
+# follows the number of cloud edges crossed by the rows rather than the number of pixels. Polygons are turned
+# into the same kind of runs (the pixels whose centers are inside, as in ClearValueRaster) by cutting them with
+# one horizontal line per row, and every area is then interval arithmetic on the two sets of runs. Results are
+# pixel exact against the raster: no simplification, no vertex snapping.
+
+import json
+
+import numpy as np
+import shapely
+
+from ClearValueRaster import Grid
+
+
+class CloudMask:
+    """ Cloudy pixel runs of a Grid sorted by row then start column """
+
+    def __init__(self, grid, rows, starts, stops):
+
+        self.grid = grid
+        self.rows = np.asarray(rows, dtype="int32")
+        self.starts = np.asarray(starts, dtype="int32")
+        self.stops = np.asarray(stops, dtype="int32")
+
+        # Runs as positions on the grid read row by row, and the cloudy pixel count before each run
+        self.keys = self.rows.astype("int64") * (grid.cols + 1) + self.starts
+        self.before = np.r_[0, np.cumsum(self.stops - self.starts)]
+
+    @classmethod
+    def from_windows(cls, grid, read_window, nodata=0, window_rows=256):
+        """ Returns the mask of the pixels other than nodata, reading the weather raster a band of rows at a time """
+
+        rows, starts, stops = [], [], []
+
+        for row in range(0, grid.rows, window_rows):
+            nrows = min(window_rows, grid.rows - row)
+            cloudy = np.asarray(read_window(row, 0, nrows, grid.cols)) != nodata
+
+            # Runs start where a row turns cloudy and stop where it turns clear
+            edges = np.diff(np.pad(cloudy, ((0, 0), (1, 1))).astype("int8"), axis=1)
+            run_rows, run_starts = np.nonzero(edges == 1)
+            _, run_stops = np.nonzero(edges == -1)
+
+            rows.append(run_rows + row)
+            starts.append(run_starts)
+            stops.append(run_stops)
+
+        return cls(grid, np.concatenate(rows), np.concatenate(starts), np.concatenate(stops))
+
+    @classmethod
+    def from_array(cls, weather, grid, nodata=0):
+        """ Returns the mask of the pixels of an in memory weather array other than nodata """
+
+        return cls.from_windows(grid, lambda row, col, nrows, ncols: weather[row:row + nrows, col:col + ncols], nodata)
+
+    def cloudy_before(self, rows, cols):
+        """ Returns the number of cloudy pixels before the given pixels reading the grid row by row """
+
+        key = np.asarray(rows, dtype="int64") * (self.grid.cols + 1) + cols
+        k = np.searchsorted(self.keys, key, side="right") - 1
+        run = np.maximum(k, 0)
+
+        inside = np.clip(key - self.keys[run], 0, (self.stops - self.starts)[run]) if len(self.keys) else 0
+
+        return np.where(k >= 0, self.before[run] + inside, 0)
+
+    def cloudy_pixels(self, rows, starts, stops):
+        """ Returns the number of cloudy pixels in each of the given runs """
+
+        return self.cloudy_before(rows, stops) - self.cloudy_before(rows, starts)
+
+    def areas(self, geometries):
+        """ Returns (area_km2, cloudy_km2) of the pixels whose centers are inside each of the given polygons """
+
+        geometries = np.asarray(geometries, dtype=object)
+        owner, rows, starts, stops = polygon_runs(geometries, self.grid)
+        pixel_area = self.grid.row_areas(0, self.grid.rows)[rows]
+
+        area = np.bincount(owner, weights=(stops - starts) * pixel_area, minlength=len(geometries))
+        cloudy = np.bincount(owner, weights=self.cloudy_pixels(rows, starts, stops) * pixel_area, minlength=len(geometries))
+
+        return area, cloudy
+
+    def cloud_fraction(self, geometries):
+        """ Returns the cloudy fraction of each of the given polygons, e.g. the footprints of inventory collects """
+
+        geometries = np.asarray(geometries, dtype=object)
+        area, cloudy = self.areas(geometries)
+
+        # Polygons too small to hold a pixel center take the state of the pixel they lie in
+        points = shapely.get_coordinates(shapely.point_on_surface(geometries))
+        cols = np.floor((points[:, 0] - self.grid.left) / self.grid.cell_width).astype("int64")
+        rows = np.floor((self.grid.top - points[:, 1]) / self.grid.cell_height).astype("int64")
+        on_grid = (rows >= 0) & (rows < self.grid.rows) & (cols >= 0) & (cols < self.grid.cols)
+
+        point_cloudy = np.zeros(len(geometries))
+        point_cloudy[on_grid] = self.cloudy_pixels(rows[on_grid], cols[on_grid], cols[on_grid] + 1)
+
+        return np.divide(cloudy, area, out=point_cloudy, where=area > 0)
+
+    def clip(self, footprint):
+        """ Returns the mask of the cloudy pixels whose centers are inside the footprint """
+
+        _, rows, starts, stops = polygon_runs(np.array([footprint], dtype=object), self.grid)
+        width = self.grid.cols + 1
+
+        # Cloud runs overlapping each footprint run, both sets being sorted and disjoint within a row
+        first = np.maximum(np.searchsorted(self.keys, rows.astype("int64") * width + starts, side="right") - 1, 0)
+        last = np.searchsorted(self.keys, rows.astype("int64") * width + stops, side="left")
+        counts = np.maximum(last - first, 0)
+
+        run = np.repeat(first, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        outer = np.repeat(np.arange(len(rows)), counts)
+
+        keep = self.rows[run] == rows[outer]
+        run, outer = run[keep], outer[keep]
+        clipped_starts = np.maximum(self.starts[run], starts[outer])
+        clipped_stops = np.minimum(self.stops[run], stops[outer])
+        keep = clipped_starts < clipped_stops
+
+        order = np.lexsort((clipped_starts[keep], rows[outer][keep]))
+
+        return CloudMask(self.grid, rows[outer][keep][order], clipped_starts[keep][order], clipped_stops[keep][order])
+
+    def area_km2(self):
+        """ Returns the cloudy area of the mask """
+
+        return float(np.sum((self.stops - self.starts) * self.grid.row_areas(0, self.grid.rows)[self.rows]))
+
+    def read_window(self, row, col, nrows, ncols):
+        """ Returns a uint8 window of the mask, 1 where cloudy, in place of reading the weather raster """
+
+        window = np.zeros((nrows, ncols + 1), dtype="int8")
+        inside = (self.rows >= row) & (self.rows < row + nrows) & (self.stops > col) & (self.starts < col + ncols)
+
+        # Mark the run edges and fill between them
+        run_rows = self.rows[inside] - row
+        np.add.at(window, (run_rows, np.clip(self.starts[inside] - col, 0, ncols)), 1)
+        np.add.at(window, (run_rows, np.clip(self.stops[inside] - col, 0, ncols)), -1)
+
+        return np.cumsum(window, axis=1)[:, :ncols].astype("uint8")
+
+    def save(self, path):
+        """ Writes the runs and grid to a compressed .npz file """
+
+        np.savez_compressed(path, rows=self.rows, starts=self.starts, stops=self.stops, grid=json.dumps(vars(self.grid)))
+
+    @classmethod
+    def load(cls, path):
+        """ Returns the mask saved at path """
+
+        with np.load(path) as data:
+            return cls(Grid(**json.loads(str(data["grid"]))), data["rows"], data["starts"], data["stops"])
+
+def polygon_runs(geometries, grid):
+    """ Returns (geometry index, row, start, stop) of the runs of pixels whose centers are inside each polygon """
+
+    xs, ys = grid.centers(0, 0, grid.rows, grid.cols)
+    bounds = shapely.bounds(geometries)
+
+    # Rows whose centers fall within each polygon's bounding box
+    r0 = np.searchsorted(-ys, -bounds[:, 3])
+    r1 = np.searchsorted(-ys, -bounds[:, 1], side="right")
+    counts = np.where(np.isnan(bounds[:, 0]), 0, np.maximum(r1 - r0, 0))
+
+    owner = np.repeat(np.arange(len(geometries)), counts)
+    rows = np.repeat(r0, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+
+    # Cut every polygon with a horizontal line through the center of each of its rows
+    lines = shapely.linestrings(np.stack([np.column_stack([bounds[owner, 0] - grid.cell_width, ys[rows]]),
+                                          np.column_stack([bounds[owner, 2] + grid.cell_width, ys[rows]])], axis=1))
+    pieces, index = shapely.get_parts(shapely.intersection(geometries[owner], lines), return_index=True)
+    keep = (shapely.get_type_id(pieces) == 1) & ~shapely.is_empty(pieces)
+    pieces, index = pieces[keep], index[keep]
+
+    # Columns whose centers are within each piece
+    piece_bounds = shapely.bounds(pieces)
+    starts = np.clip(np.ceil((piece_bounds[:, 0] - grid.left) / grid.cell_width - 0.5), 0, grid.cols).astype("int32")
+    stops = np.clip(np.floor((piece_bounds[:, 2] - grid.left) / grid.cell_width - 0.5) + 1, 0, grid.cols).astype("int32")
+    keep = starts < stops
+
+    return owner[index][keep], rows[index][keep], starts[keep], stops[keep]
@@ -0,0 +1,40 @@
+# Author: Casey Betts, 2024
+# Per rev collection metrics computed for every rev of the inventory in one pass
+
+import numpy as np
+import pandas as pd
+
+# Cloud cover below this value counts as a clear collect
+CLEAR_THRESHOLD = 15
+
+# Default cloud cover histogram bin edges
+CC_BINS = [0, 5, 15, 30, 50, 75, 100]
+
+
+def collection_metrics(revs, cc, bins=CC_BINS, clear_threshold=CLEAR_THRESHOLD):
+    """ Returns a table indexed by rev of the collect counts, clear ratio, cloud cover statistics and a cloud cover
+    histogram given columnar arrays of each collect's rev and cloud cover """
+
+    df = pd.DataFrame({"rev": np.asarray(revs), "cc": np.asarray(cc, dtype="float64")})
+    df["clear"] = df.cc < clear_threshold
+
+    grouped = df.groupby("rev")
+    table = grouped.agg(collects=("cc", "size"),
+                        clear_collects=("clear", "sum"),
+                        mean_cc=("cc", "mean"),
+                        median_cc=("cc", "median"))
+
+    # Collects at or over the threshold are cloudy, so no collect is left uncounted
+    table["cloudy_collects"] = table.collects - table.clear_collects
+    table["clear_ratio"] = table.clear_collects / table.collects
+
+    # One column per cloud cover bin, bins include their lower edge and the last bin includes its upper edge too
+    labels = [f"cc_{low:g}_{high:g}" for low, high in zip(bins[:-1], bins[1:])]
+    index = np.searchsorted(bins, df.cc, side="right") - 1
+    index[df.cc == bins[-1]] = len(labels) - 1
+    index[(df.cc < bins[0]) | (df.cc > bins[-1]) | df.cc.isna()] = -1
+
+    histogram = pd.crosstab(df.rev, pd.Categorical.from_codes(index, labels), dropna=False)
+    table = table.join(histogram.reindex(columns=labels, fill_value=0)).fillna({label: 0 for label in labels})
+
+    return table
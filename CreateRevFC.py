@@ -2,9 +2,22 @@
 # Creates feature classes from an ONV layer
 
 import arcpy
+import os
 import pandas as pd
+import re
+import shapely
 
+from itertools import groupby, islice
 
+from Instrumentation import feature_count, instrument
+from RevCatalog import RevCatalog
+from Subdivision import equal_area_cells
+
+# Path to the geodatabase, CSI_WORKSPACE points the tools at another one
+GEODATABASE = os.environ.get("CSI_WORKSPACE", "C:\\Users\\ca003927\\OneDrive - Maxar Technologies Holdings Inc\\Private Drop\\Git\\Clear_Sky_Insight\\CSI_GeoDatabase.gdb")
+
+
+@instrument(inputs=lambda onv_layer: {"onv_features": feature_count(onv_layer)}, outputs=lambda revs: {"revs": len(revs)})
 def find_revs(onv_layer):
     """ Returns a list of unique revs given an ONV feature class """
 
@@ -18,22 +31,67 @@ def find_revs(onv_layer):
 
     return revs
 
-def rev_feature_classes(onv_layer, rev_nums):
-    """ Creates feature classes for each rev and saves to a geodatabase """
+def parse_revs(rev_nums):
+    """ Returns a list of revs given an iterable of revs or its string form, e.g. the tool parameter "{123, 456}" """
 
-    arcpy.AddMessage("Here are the revs from CreateRevFeatureClass: " + str(rev_nums))
-    revs = list(rev_nums[1:-1].split(", "))
+    if isinstance(rev_nums, str):
+        return re.findall(r"\d+", rev_nums)
+
+    return [str(rev) for rev in rev_nums]
+
+@instrument(inputs=lambda onv_layer, *args, **kwargs: {"onv_features": feature_count(onv_layer)}, outputs=lambda result: {"revs": len(result[1])})
+def partition_onv(onv_layer, location, revs=None, catalog_path=None):
+    """ Writes a rev_<rev> feature class for every rev of the ONV layer (or only the given revs) in a single pass
+    sorted by rev, days and ona, and returns the catalog of the slices saved next to the location and the revs written """
+
+    location = str(location).rstrip("\\/")
+    catalog = RevCatalog(catalog_path or os.path.splitext(location)[0] + "_revs.json")
+
+    describe = arcpy.Describe(onv_layer)
+    fields = [field.name for field in arcpy.ListFields(onv_layer) if field.editable and field.type not in ("OID", "Geometry")]
+    rev_i, days_i, ona_i = (fields.index(name) + 1 for name in ("rev_num", "days", "ona"))
+
+    where = None if revs is None else f"\"rev_num\" IN ({', '.join(parse_revs(revs)) or 'NULL'})"
+    written = []
+
+    # ORDER BY is only honored on database sources, rows of shapefiles and dBASE tables are sorted here instead
+    database = any(part.lower().endswith((".gdb", ".sde", ".gpkg", ".sqlite")) for part in re.split(r"[\\/]", describe.catalogPath))
+
+    # Sorted rows arrive one rev at a time, so each rev's output is written while the next rev is still unread
+    with arcpy.da.SearchCursor(onv_layer, ["SHAPE@"] + fields, where, sql_clause=(None, "ORDER BY rev_num, days, ona")) as rows:
+        if not database:
+            rows = sorted(rows, key=lambda row: (row[rev_i], row[days_i], row[ona_i]))
+
+        for rev, group in groupby(rows, key=lambda row: row[rev_i]):
+
+            # A rev coming up twice would overwrite its slice and reset its catalog offsets
+            rev = str(rev)
+            if rev in written:
+                raise ValueError(f"Rows of rev {rev} are not contiguous in '{describe.catalogPath}', the source ignored ORDER BY.")
 
-    # Select each set of features
-    for rev in list(revs):
+            arcpy.AddMessage("Current rev: " + rev)
 
-        selection = f"\"rev_num\" = {rev}"
-        output_name = "C:\\Users\\ca003927\\OneDrive - Maxar Technologies Holdings Inc\\Private Drop\\Git\\Clear_Sky_Insight\\CSI_GeoDatabase.gdb\\rev_" + rev
+            output = str(arcpy.management.CreateFeatureclass(location, "rev_" + rev, "POLYGON", onv_layer, spatial_reference=describe.spatialReference)[0])
+            catalog.start(rev, output, describe.catalogPath)
+            written.append(rev)
 
-        arcpy.AddMessage("Current rev: " + rev)
-        arcpy.conversion.ExportFeatures(onv_layer, 
-                                        output_name,
-                                        selection)
+            with arcpy.da.InsertCursor(output, ["SHAPE@"] + fields) as cursor:
+                for row in group:
+                    cursor.insertRow(row)
+                    extent = row[0].extent if row[0] is not None else None
+                    catalog.add(rev, row[days_i], row[ona_i], extent and (extent.XMin, extent.YMin, extent.XMax, extent.YMax))
+
+    catalog.save()
+
+    return catalog, written
+
+@instrument()
+def rev_feature_classes(onv_layer, rev_nums, location=GEODATABASE):
+    """ Creates feature classes for each rev and saves to a geodatabase """
+
+    arcpy.AddMessage("Here are the revs from CreateRevFeatureClass: " + str(rev_nums))
+
+    return partition_onv(onv_layer, location, parse_revs(rev_nums))
         
 def export(layer, location, name, identifier):
     """ Exports the given layer to the given location with the given identifier appended to the given name """
@@ -44,29 +102,44 @@ def export(layer, location, name, identifier):
     # arcpy.conversion.ExportFeatures(layer, location + output_name)
     arcpy.management.MultipartToSinglepart(layer, location + output_name)
 
-def subdivide(layer, location, name, identifier, parts, direction):
-    """ Exports a layer divided into equal area pieces """
+@instrument(inputs=lambda layer, *args, **kwargs: {"input_features": feature_count(layer)}, outputs=lambda out_path: {"cells": feature_count(out_path)})
+def subdivide(layer, location, name, identifier, parts, direction, target_km2=50, angle=90, batch_size=256):
+    """ Exports a layer divided into equal area strips of target_km2 with cut lines at angle degrees, each strip
+    keeping the attributes of its polygon """
 
     output_name = str(name) + "_" + str(identifier)
     location = str(location) + "\\"
     arcpy.AddMessage(location + output_name)
     out_path = location + output_name
 
-    arcpy.management.SubdividePolygon(layer, out_path, "EQUAL_AREAS", "" , "50 SquareKilometers", "" , 90, "STRIPS")
+    # The output has the fields of the input layer
+    spatial_reference = arcpy.Describe(layer).spatialReference
+    arcpy.management.CreateFeatureclass(location, output_name, "POLYGON", layer, spatial_reference=spatial_reference)
+    fields = [field.name for field in arcpy.ListFields(layer) if field.editable and field.type not in ("OID", "Geometry")]
 
+    # Cut a batch of polygons at a time and write its strips before reading the next
+    with arcpy.da.SearchCursor(layer, ["SHAPE@WKB"] + fields) as rows, arcpy.da.InsertCursor(out_path, ["SHAPE@"] + fields) as cursor:
+        while batch := list(islice(rows, batch_size)):
+            cells, index, _ = equal_area_cells(shapely.from_wkb([bytes(row[0]) for row in batch]), target_km2, angle)
+
+            for cell, i in zip(shapely.to_wkb(cells), index):
+                cursor.insertRow([arcpy.FromWKB(cell, spatial_reference)] + list(batch[i][1:]))
+
+    return out_path
+
+@instrument(inputs=lambda orders_layer, onv_layer, location: {"orders_features": feature_count(orders_layer)})
 def orders_by_rev(orders_layer, onv_layer, location):
     """ Creates a feature class of orders for each rev """
 
-    for rev in find_revs(onv_layer):
+    # Split the ONV into its revs in one pass
+    catalog, revs = partition_onv(onv_layer, location)
 
-        # Select the rev in the ONV file
-        selection = f"\"rev_num\" = {rev}"
-        arcpy.management.SelectLayerByAttribute(onv_layer, 'NEW_SELECTION', selection)
-        
-        # Select the orders intersecting the ONV selection 
+    for rev in revs:
+
+        # Select the orders intersecting the rev's slice of the ONV
         arcpy.management.SelectLayerByLocation(orders_layer, 
                                                 "INTERSECT", 
-                                                onv_layer, 
+                                                catalog.output(rev), 
                                                 None, 
                                                 "NEW_SELECTION", 
                                                 "NOT_INVERT")
@@ -76,7 +149,6 @@ def orders_by_rev(orders_layer, onv_layer, location):
 
 
 
-
 # 1) Find rev numbers
 # 2) Iterate on rev numbers
 # 	2.1) Select rev from ONV file
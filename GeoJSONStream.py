@@ -0,0 +1,65 @@
+# Author: Casey Betts, 2024
+# Reads the features of a GeoJSON FeatureCollection one at a time instead of loading the whole file
+
+import json
+import re
+
+import numpy as np
+
+FEATURES_START = re.compile(r'"features"\s*:\s*\[')
+SEPARATORS = re.compile(r'[\s,]*')
+
+
+def iter_features(path, chunk_size=1 << 20):
+    """ Yields each feature dict of the FeatureCollection in the given file while holding only a chunk of its text """
+
+    decoder = json.JSONDecoder()
+
+    with open(path, encoding="utf-8") as f:
+
+        buffer = ""
+        match = None
+
+        # Find the start of the features array
+        while match is None:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            buffer += chunk
+            match = FEATURES_START.search(buffer)
+
+        position = match.end()
+        eof = False
+
+        while True:
+
+            # Skip the separators between features
+            position = SEPARATORS.match(buffer, position).end()
+            if buffer.startswith("]", position):
+                return
+
+            try:
+                feature, end = decoder.raw_decode(buffer, position)
+
+            except json.JSONDecodeError:
+                # The feature runs past the end of the buffer, drop what was read and read more of the file
+                if eof:
+                    raise
+                chunk = f.read(chunk_size)
+                eof = not chunk
+                buffer = buffer[position:] + chunk
+                position = 0
+                continue
+
+            position = end
+            yield feature
+
+def compact_feature(feature, properties):
+    """ Returns a tuple of the given properties of a feature and a list of float64 arrays, one per polygon ring """
+
+    geometry = feature["geometry"]
+    polygons = geometry["coordinates"] if geometry["type"] == "MultiPolygon" else [geometry["coordinates"]]
+
+    rings = [np.asarray(ring, dtype="float64") for polygon in polygons for ring in polygon]
+
+    return tuple(feature["properties"].get(name) for name in properties), rings
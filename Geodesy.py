@@ -0,0 +1,59 @@
+# Author: Casey Betts, 2024
+# Great circle distance and spherical area functions shared by the order dataframe, the value layers and the benchmarks
+
+import numpy as np
+import shapely
+
+from math import asin, sqrt, sin, cos, radians
+
+EARTH_RADIUS_KM = 6371
+
+
+def get_distance(a, b):
+    """ Returns the distance in km between two points given a tuple of (lat, lon) in degrees of each """
+
+    lat1, lon1 = map(radians, a)
+    lat2, lon2 = map(radians, b)
+
+    h = sin((lat2 - lat1) / 2) ** 2 + cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2) ** 2
+
+    return 2 * EARTH_RADIUS_KM * asin(sqrt(min(1.0, h)))
+
+def get_distances(lat1, lon1, lat2, lon2):
+    """ Returns an array of haversine distances in km between arrays of points given in degrees """
+
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(v, dtype="float64")) for v in (lat1, lon1, lat2, lon2))
+
+    # The haversine term is periodic in longitude so boxes crossing the antimeridian need no special case
+    h = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+
+    # Rounding can push h slightly outside [0, 1] for identical or antipodal points
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(h, 0.0, 1.0)))
+
+def polygon_areas(geometries):
+    """ Returns an array of the areas in km² on the sphere of the given polygons or multipolygons in degrees """
+
+    geometries = np.asarray(geometries, dtype=object)
+
+    # Pack every ring of every polygon part into one coordinate array
+    parts, part_index = shapely.get_parts(geometries, return_index=True)
+    rings, ring_part = shapely.get_rings(parts, return_index=True)
+    coords, ring_index = shapely.get_coordinates(rings, return_index=True)
+
+    lon, lat = np.radians(coords[:, 0]), np.radians(coords[:, 1])
+    same_ring = ring_index[1:] == ring_index[:-1]
+
+    # Signed ring areas from the sum of (lon2 - lon1) * (sin lat1 + sin lat2) / 2 over the edges, taken relative
+    # to the first vertex of the ring so tiny slivers keep their precision, longitude steps wrapped across 180°
+    ring_start = np.flatnonzero(np.r_[True, ~same_ring][:len(lat)])
+    sin_lat = np.sin(lat) - np.repeat(np.sin(lat[ring_start]), np.diff(np.r_[ring_start, len(lat)]))
+    d_lon = (lon[1:] - lon[:-1] + np.pi) % (2 * np.pi) - np.pi
+    edges = d_lon * (sin_lat[1:] + sin_lat[:-1]) / 2
+
+    ring_areas = np.abs(np.bincount(ring_index[:-1][same_ring], weights=edges[same_ring], minlength=len(rings)))
+
+    # The first ring of each part is its exterior, the others are holes
+    exterior = np.r_[True, ring_part[1:] != ring_part[:-1]] if len(rings) else np.empty(0, dtype=bool)
+    part_areas = np.bincount(ring_part, weights=np.where(exterior, ring_areas, -ring_areas), minlength=len(parts))
+
+    return EARTH_RADIUS_KM ** 2 * np.bincount(part_index, weights=part_areas, minlength=len(geometries))
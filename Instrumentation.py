@@ -0,0 +1,198 @@
+# Author: Casey Betts, 2024
+# Records wall time, CPU time, memory and feature counts of each pipeline stage as json lines
+
+import cProfile
+import functools
+import json
+import os
+import sys
+
+from contextlib import contextmanager
+from datetime import datetime
+from time import perf_counter, process_time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Where records go and which stages are profiled, see configure()
+settings = {"path": os.environ.get("CSI_METRICS"),
+            "profile_dir": os.environ.get("CSI_PROFILE_DIR"),
+            "profile_stages": set(filter(None, os.environ.get("CSI_PROFILE_STAGES", "").split(","))),
+            "profiler": cProfile.Profile,
+            "counts": True}
+
+# Fields added to every record, see tagged()
+tags = {}
+
+# Name of the stage being profiled, nested stages are timed but left to the outer stage's profile
+profiling = {"stage": None}
+
+
+def configure(path=None, profile_dir=None, profile_stages=(), profiler=cProfile.Profile, counts=True):
+    """ Sets the json lines file records are appended to and the stages to profile (all stages with "*")
+
+    profiler is a factory of objects with enable(), disable() and dump_stats(path) such as cProfile.Profile,
+    each profiled stage writes <profile_dir>/<stage>_<timestamp>.prof. Only the outermost profiled stage is
+    profiled, stages inside it show up in its profile. counts=False skips the feature counts.
+    """
+
+    settings.update(path=path, profile_dir=profile_dir, profile_stages=set(profile_stages), profiler=profiler, counts=counts)
+
+def current_rss_mb():
+    """ Returns the resident memory of the process in MB, or None where it cannot be read """
+
+    if psutil is not None:
+        return psutil.Process().memory_info().rss / 2 ** 20
+
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def peak_rss_mb():
+    """ Returns the peak resident memory of the process so far in MB, or None where it cannot be read """
+
+    if resource is not None:
+        # Linux reports kilobytes, macOS bytes
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+    if psutil is not None:
+        info = psutil.Process().memory_info()
+        return getattr(info, "peak_wset", info.rss) / 2 ** 20
+
+    return None
+
+def profiler_running():
+    """ Returns whether a stage is being profiled or another profiler such as cProfile is running """
+
+    if profiling["stage"] is not None or sys.getprofile() is not None:
+        return True
+
+    # cProfile registers with sys.monitoring rather than sys.setprofile from Python 3.12
+    monitoring = getattr(sys, "monitoring", None)
+
+    return monitoring is not None and monitoring.get_tool(monitoring.PROFILER_ID) is not None
+
+@contextmanager
+def tagged(**fields):
+    """ Adds the given fields (such as the rev) to every record made inside the block """
+
+    previous = dict(tags)
+    tags.update(fields)
+
+    try:
+        yield
+    finally:
+        tags.clear()
+        tags.update(previous)
+
+def emit(record):
+    """ Appends a record to the configured json lines file """
+
+    if settings["path"]:
+        with open(settings["path"], "a") as f:
+            f.write(json.dumps(record, default=str) + "\n")
+
+@contextmanager
+def stage(name, **fields):
+    """ Times the enclosed block as the named stage and yields its record for the caller to add counts to """
+
+    record = {"stage": name, "start": datetime.now().isoformat(timespec="milliseconds"), **tags, **fields}
+
+    profile = settings["profile_dir"] and (name in settings["profile_stages"] or "*" in settings["profile_stages"])
+    profiler = settings["profiler"]() if profile and not profiler_running() else None
+
+    rss_before = current_rss_mb()
+    wall, cpu = perf_counter(), process_time()
+    if profiler:
+        profiler.enable()
+        profiling["stage"] = name
+
+    try:
+        yield record
+        record["status"] = "ok"
+
+    except BaseException as e:
+        record["status"] = "failed"
+        record["error"] = repr(e)
+        raise
+
+    finally:
+        if profiler:
+            profiler.disable()
+            profiling["stage"] = None
+            os.makedirs(settings["profile_dir"], exist_ok=True)
+            profiler.dump_stats(os.path.join(settings["profile_dir"], f"{name}_{datetime.now():%Y%m%d_%H%M%S}.prof"))
+
+        record["wall_seconds"] = perf_counter() - wall
+        record["cpu_seconds"] = process_time() - cpu
+        record["rss_mb"] = current_rss_mb()
+        record["rss_delta_mb"] = None if rss_before is None or record["rss_mb"] is None else record["rss_mb"] - rss_before
+        # Peak of the whole process so far, not of this stage, it only rises past earlier stages' peaks
+        record["process_peak_rss_mb"] = peak_rss_mb()
+        emit(record)
+
+def instrument(name=None, inputs=None, outputs=None):
+    """ Decorates a function to be recorded as a stage
+
+    inputs(*args, **kwargs) and outputs(result) may return dicts of counts to add to the record, they are only
+    called when counts are enabled and records are written.
+    """
+
+    def decorator(func):
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+
+            with stage(name or func.__name__) as record:
+                count = settings["counts"] and settings["path"]
+
+                if inputs and count:
+                    record.update(inputs(*args, **kwargs))
+
+                result = func(*args, **kwargs)
+
+                if outputs and count:
+                    record.update(outputs(result))
+
+                return result
+
+        return wrapper
+
+    return decorator
+
+# Counts for the stage records, arcpy is only imported by the ArcPro stages that count with it
+def feature_count(data):
+    """ Returns the number of features (or selected features) of the given layer """
+
+    import arcpy
+
+    return int(arcpy.management.GetCount(data)[0])
+
+def pixel_count(raster):
+    """ Returns the number of pixels of the given raster """
+
+    import arcpy
+
+    raster = arcpy.Raster(raster)
+
+    return raster.width * raster.height
+
+def input_counts(**positions):
+    """ Returns a callable giving the feature count of the named positional arguments of a stage """
+
+    return lambda *args, **kwargs: {name + "_features": feature_count(args[i]) for name, i in positions.items()}
+
+def output_counts(layer):
+    """ Returns the feature count of the layer a stage returned """
+
+    return {"output_features": feature_count(layer)}
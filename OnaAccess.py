@@ -0,0 +1,60 @@
+# Author: Casey Betts, 2024
+# Classifies which orders a rev can access given the order's max ONA in a single spatial index pass
+
+import numpy as np
+
+from shapely import STRtree
+
+# ONV band values stepped through by the original attribute/location selection, widest first
+ONV_VALUES = [35, 30, 25, 20, 15]
+
+
+def min_intersecting_ona(order_geometries, band_geometries, band_onas, onas=None):
+    """ Returns the minimum ONA of the bands each order intersects (inf where it intersects none)
+
+    If onas is given only bands with one of those values are considered.
+    """
+
+    band_onas = np.asarray(band_onas, dtype="float64")
+    result = np.full(len(order_geometries), np.inf)
+
+    keep = np.ones(len(band_onas), dtype=bool) if onas is None else np.isin(band_onas, onas)
+    if not keep.any():
+        return result
+
+    tree = STRtree(np.asarray(band_geometries, dtype=object)[keep])
+    order_index, band_index = tree.query(order_geometries, predicate="intersects")
+    np.minimum.at(result, order_index, band_onas[keep][band_index])
+
+    return result
+
+def accessible_orders(order_geometries, max_onas, band_geometries, band_onas, respect_ona=True):
+    """ Returns (keep, access_ona) arrays giving which orders are selected for the rev and the lowest
+    ONA band of the rev each order intersects
+
+    The selection is the same as intersecting the whole rev and then, for each ONA in ONV_VALUES, removing
+    orders with max_ona < ona + 1 and adding back orders intersecting that ONA band.
+    """
+
+    access_ona = min_intersecting_ona(order_geometries, band_geometries, band_onas)
+    keep = np.isfinite(access_ona)
+
+    if not respect_ona:
+        return keep, access_ona
+
+    max_onas = np.asarray(max_onas, dtype="float64")
+    steps = np.array(sorted(ONV_VALUES))
+
+    # Lowest stepped band the order intersects: the last pass that adds it back
+    band = min_intersecting_ona(order_geometries, band_geometries, band_onas, steps)
+
+    # Lowest step whose max ONA test removes the order: the last pass that removes it
+    removed = max_onas[:, None] < steps[None, :] + 1
+    removal = np.where(removed.any(axis=1), steps[np.argmax(removed, axis=1)], np.inf)
+
+    # Passes run from the highest ONA down and a pass removes before it adds, so the lowest step touching
+    # the order decides; orders no pass touches keep their initial selection
+    touched = np.isfinite(band) | np.isfinite(removal)
+    keep = np.where(touched, band <= removal, keep)
+
+    return keep, access_ona
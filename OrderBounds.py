@@ -0,0 +1,49 @@
+# Author: Casey Betts, 2024
+# Bounding boxes and dimensions of the orders from a GeoJSON export of the orders layer, runs without ArcPro
+
+from collections import Counter
+
+import pandas as pd
+
+from GeoJSONStream import compact_feature, iter_features
+from Geodesy import get_distances
+
+
+def bbox_index(path):
+    """ Returns a dataframe of the bounding box of each geojson feature keyed on (external_i, part_index) """
+
+    rows = []
+    seen = Counter()
+
+    for feature in iter_features(path):
+
+        (order,), rings = compact_feature(feature, ["external_i"])
+        x_max, y_max = rings[0].max(axis=0)
+        x_min, y_min = rings[0].min(axis=0)
+
+        # Parts of the same order are numbered in the order they appear in the geojson file
+        rows.append((order, seen[order], x_max, x_min, y_max, y_min))
+        seen[order] += 1
+
+    return pd.DataFrame(rows, columns=["external_i", "part_index", "x_max", "x_min", "y_max", "y_min"])
+
+def join_bboxes(external_ids, bboxes):
+    """ Returns the (x_max, x_min, y_max, y_min) dataframe of the given order ids, one row each in the same order """
+
+    # Number each row of a duplicated order id (former multipart polygons) the same way the index is keyed
+    keys = pd.DataFrame({"external_i": pd.Series(external_ids).values})
+    keys["part_index"] = keys.groupby("external_i", sort=False).cumcount(ascending=False).values
+
+    # Join the bounding boxes onto the orders in a single merge
+    merged = keys.merge(bboxes, how="left", on=["external_i", "part_index"])
+
+    return merged[["x_max", "x_min", "y_max", "y_min"]]
+
+def bbox_dimensions(df):
+    """ Returns (width, height) in km of the bounding boxes of a dataframe with x/y min/max columns """
+
+    # Width along the southern edge and height along the western edge of each bounding box
+    width = get_distances(df.y_min, df.x_min, df.y_min, df.x_max)
+    height = get_distances(df.y_min, df.x_min, df.y_max, df.x_min)
+
+    return width, height
@@ -0,0 +1,166 @@
+# Author: Casey Betts, 2024
+# ArcPro-free engine that slices overlapping orders into faces and sums the order values on each face
+
+import hashlib
+
+import numpy as np
+import shapely
+
+from shapely import STRtree
+
+# Grid in degrees (about 0.01 mm) order boundaries are snapped to when they are noded
+NODING_GRID = 1e-10
+
+
+def csi_value(tasking_priority):
+    """ Returns the CSI value of an order given its tasking priority (stored as a LONG like the ArcPro field) """
+
+    return np.trunc((100 - (np.asarray(tasking_priority, dtype="float64") - 700)) ** 1.5)
+
+def overlap_groups(geometries, tree=None):
+    """ Returns an array labeling each geometry with the id of the group of geometries it transitively overlaps """
+
+    tree = tree if tree is not None else STRtree(geometries)
+
+    # Candidate pairs pruned by the spatial index, so the cost follows the number of real overlaps
+    left, right = tree.query(geometries, predicate="intersects")
+
+    # Union-find over the overlapping pairs
+    parent = np.arange(len(geometries))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, j in zip(left[left < right], right[left < right]):
+        root_i, root_j = find(i), find(j)
+        if root_i != root_j:
+            parent[max(root_i, root_j)] = min(root_i, root_j)
+
+    return np.array([find(i) for i in range(len(geometries))])
+
+def group_faces(geometries, values):
+    """ Returns the faces of the planar arrangement of one group of overlapping orders with their summed values """
+
+    # Node every order boundary against every other and rebuild the polygons between them. Nearly collinear edges,
+    # such as those of orders clipped to the same tile edge, only node reliably when snapped to a grid
+    linework = shapely.union_all(shapely.boundary(geometries), grid_size=NODING_GRID)
+    faces = shapely.get_parts(shapely.polygonize(shapely.get_parts(linework)))
+
+    # Orders containing a point inside each face
+    tree = STRtree(geometries)
+    face_index, order_index = tree.query(shapely.point_on_surface(faces), predicate="within")
+
+    # A point of a face thinner than the grid can land just outside its orders, such faces take the orders
+    # covering most of their area instead
+    missed = np.setdiff1d(np.arange(len(faces)), face_index)
+    near_face, near_order = tree.query(faces[missed], predicate="intersects")
+    overlap = shapely.area(shapely.intersection(faces[missed][near_face], geometries[near_order]))
+    covers = overlap > shapely.area(faces[missed][near_face]) / 2
+
+    face_index = np.concatenate([face_index, missed[near_face][covers]])
+    order_index = np.concatenate([order_index, near_order[covers]])
+
+    sums = np.bincount(face_index, weights=np.asarray(values, dtype="float64")[order_index], minlength=len(faces))
+    counts = np.bincount(face_index, minlength=len(faces))
+
+    # Faces that are holes between orders are not covered by any order
+    keep = counts > 0
+
+    return faces[keep], sums[keep], counts[keep]
+
+def sum_overlay(geometries, values):
+    """ Returns (faces, summed values, join counts) for the stacked value surface of the given order polygons """
+
+    geometries = np.asarray(geometries, dtype=object)
+    values = np.asarray(values, dtype="float64")
+
+    faces, sums, counts = [], [], []
+
+    groups = overlap_groups(geometries)
+    order = np.argsort(groups, kind="stable")
+    starts = np.flatnonzero(np.r_[True, groups[order][1:] != groups[order][:-1]])
+
+    for members in np.split(order, starts[1:]):
+
+        # An order overlapping nothing is a face of its own
+        if len(members) == 1:
+            faces.append(geometries[members])
+            sums.append(values[members])
+            counts.append(np.ones(1, dtype="int64"))
+            continue
+
+        group = group_faces(geometries[members], values[members])
+        faces.append(group[0])
+        sums.append(group[1])
+        counts.append(group[2])
+
+    if not faces:
+        return np.empty(0, dtype=object), np.empty(0), np.empty(0, dtype="int64")
+
+    return np.concatenate(faces), np.concatenate(sums), np.concatenate(counts)
+
+def polygon_parts(geometries):
+    """ Returns the non-empty polygon parts of the given geometries and the index of the geometry each came from """
+
+    parts, index = shapely.get_parts(geometries, return_index=True)
+    keep = (shapely.get_type_id(parts) == 3) & (shapely.area(parts) > 0)
+
+    return parts[keep], index[keep]
+
+def deck_keys(ids, geometries, values):
+    """ Returns a key per order made of its id and a hash of its geometry and value """
+
+    wkbs = shapely.to_wkb(np.asarray(geometries, dtype=object))
+
+    return np.array([f"{order}:{hashlib.sha1(wkb + repr(float(value)).encode()).hexdigest()}"
+                     for order, wkb, value in zip(ids, wkbs, values)])
+
+def diff_decks(old_keys, new_keys):
+    """ Returns the indexes of the old orders no longer in the new deck and of the new orders not in the old deck """
+
+    removed = np.flatnonzero(~np.isin(old_keys, new_keys))
+    added = np.flatnonzero(~np.isin(new_keys, old_keys))
+
+    return removed, added
+
+def update_overlay(surface_faces, surface_values, surface_counts, old_geometries, old_keys, new_geometries, new_values, new_keys):
+    """ Returns (stale face indexes, faces, summed values, join counts) to splice into a stored value surface after
+    the order deck changed: the stale faces are replaced by the returned ones
+
+    Only the area covered by the changed orders (added, cancelled or re-prioritized) is recomputed, so the cost
+    follows the size of the change. Faces of the old surface crossing that area are cut along its edge, so the
+    result has the same values everywhere as a full recompute but may have a few extra seams.
+    """
+
+    surface_faces = np.asarray(surface_faces, dtype=object)
+    old_geometries = np.asarray(old_geometries, dtype=object)
+    new_geometries = np.asarray(new_geometries, dtype=object)
+    new_values = np.asarray(new_values, dtype="float64")
+
+    removed, added = diff_decks(old_keys, new_keys)
+    changed = np.concatenate([old_geometries[removed], new_geometries[added]])
+
+    if len(changed) == 0:
+        return np.empty(0, dtype="int64"), np.empty(0, dtype=object), np.empty(0), np.empty(0, dtype="int64")
+
+    # The area whose value may have changed
+    region = shapely.union_all(changed)
+
+    # Old faces touching the area are cut back to the part outside it (cutting can leave lines and points, only
+    # polygon parts are kept)
+    stale = np.unique(STRtree(surface_faces).query(changed, predicate="intersects")[1])
+    remainders, source = polygon_parts(shapely.difference(surface_faces[stale], region))
+
+    # Orders under the area are clipped to it and overlaid again
+    nearby = np.unique(STRtree(new_geometries).query(changed, predicate="intersects")[1])
+    clipped, order = polygon_parts(shapely.intersection(new_geometries[nearby], region))
+    faces, sums, counts = sum_overlay(clipped, new_values[nearby][order])
+
+    faces = np.concatenate([remainders, faces])
+    sums = np.concatenate([np.asarray(surface_values, dtype="float64")[stale][source], sums])
+    counts = np.concatenate([np.asarray(surface_counts, dtype="int64")[stale][source], counts])
+
+    return stale, faces, sums, counts
@@ -2,24 +2,40 @@
 # Defines the class containing the dataframe of ordres of a specific rev
 
 import arcpy
-import json
+import numpy as np
+import os
 import pandas as pd
 
-from collections import Counter
 from datetime import datetime
-from math import acos, sin, cos
+from itertools import islice
+
+from OrderBounds import bbox_dimensions, bbox_index, join_bboxes
+
+# Folder the tables are written to, the Output folder beside the geodatabase CSI_WORKSPACE points the tools at
+if "CSI_WORKSPACE" in os.environ:
+    OUTPUT_PATH = os.path.join(os.path.dirname(os.environ["CSI_WORKSPACE"].rstrip("\\/")), "Output")
+else:
+    OUTPUT_PATH = r"C:\Users\ca003927\OneDrive - Maxar Technologies Holdings Inc\Private Drop\Git\Clear_Sky_Insight\Output"
 
 
 class Orders:
     """ Contains the dataframe and related functions of the orders dataframe for a specific rev """
 
-    def __init__(self, layer):
+    # Low cardinality text fields stored as categoricals
+    category_columns = ["data_acces", "demand_typ", "standing_t", "sap_custom", "product_le", "order_stat", "country",
+                        "vehicle", "imagebands", "type", "scan_direc", "customer_t", "production"]
+
+    # Vehicle flags stored as (nullable) booleans
+    bool_columns = ["ge01", "wv01", "wv02", "wv03"]
+
+    def __init__(self, layer, rev=None, output_format="csv", partition_cols=None):
+
+        self.rev = rev
 
-        self.output_path = r"C:\Users\ca003927\OneDrive - Maxar Technologies Holdings Inc\Private Drop\Git\Clear_Sky_Insight\Output"
+        self.output_path = OUTPUT_PATH
 
-        # Create dict from geoJSON file
-        with open("out.geojson") as f:
-            self.geodata = json.load(f) 
+        # GeoJSON export of the layer, streamed one feature at a time when the bounding boxes are built
+        self.geodata_path = "out.geojson"
 
         # Create a list of the desired fields to include from the layer's attribute table
         fields = [  "data_acces",
@@ -92,113 +108,79 @@ class Orders:
                     "requested1",
                     "max_collec"]
 
-        # Create a dataframe from the layer
+        # Create a dataframe from the layer a chunk of rows at a time
         with arcpy.da.SearchCursor(layer, fields) as cursor:
-            self.df_orders = pd.DataFrame(list(cursor), columns=fields)
+            frames = [pd.DataFrame(chunk, columns=fields) for chunk in iter(lambda: list(islice(cursor, 50000)), [])]
+
+        self.df_orders = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=fields)
 
         # Populate the max/min lat/lon coords for each order
         self.add_columns()
         self.populate_geodata()
         self.populate_dimensions()
+        self.apply_dtypes()
 
         arcpy.AddMessage(self.df_orders.head())
 
-        # Output dataframe to csv file
-        self.output_df_to_csv()
+        # Output dataframe to a csv, parquet or feather file
+        self.output_df(output_format, partition_cols)
 
     def add_columns(self):
         """ Adds the needed columns to the dataframe """
 
         # Add max/min coord columns to dataframe
-        self.df_orders["x_max"] = ""
-        self.df_orders["x_min"] = ""
-        self.df_orders["y_max"] = ""
-        self.df_orders["y_min"] = ""
+        self.df_orders["x_max"] = np.nan
+        self.df_orders["x_min"] = np.nan
+        self.df_orders["y_max"] = np.nan
+        self.df_orders["y_min"] = np.nan
 
         # Add dimension columns to dataframe
-        self.df_orders["width"] = ""
-        self.df_orders["height"] = ""
+        self.df_orders["width"] = np.float32(np.nan)
+        self.df_orders["height"] = np.float32(np.nan)
 
-    def populate_geodata(self):
-        """ Creates and populates the geodata fields for the orders dataframe """
+    def apply_dtypes(self):
+        """ Converts the dataframe columns to compact types """
 
-        # Populate geo data columns
-        for direction in ["x", "y"]:
-            for value in ["max", "min"]:
-                # Find duplicate order ids (former multipart polygons)
-                counts = Counter(self.df_orders.external_i).items()
-                self.duplicates = [order for order, count in counts if count > 1]
-                self.count_dict = dict(counts)
-                self.df_orders[direction + "_" + value] = self.df_orders.apply(lambda x: self.get_geodata(direction, value, x.external_i), axis=1)
-
-    def get_geodata(self, direction, value, order):
-        """ Returns the vertex coordinate for of the given type for the given order """
-        
-        # Determine if there are duplicates of the order id
-        if order in self.duplicates:
-            self.count_dict[order] -= 1
-            skips = self.count_dict[order]
-
-            # Iterate through orders in the geodata dict
-            for feature in self.geodata['features']:
-
-                # Find the feature for the given order
-                if feature["properties"]["external_i"] == order:
-
-                    # If the number of skips is 0
-                    if skips == 0:
-
-                        # Return the correct coordinate value
-                        if direction == "x":
-                            vals = [i for i, j in feature['geometry']['coordinates'][0]]
-                        else:
-                            vals = [j for i, j in feature['geometry']['coordinates'][0]]
-
-                        if value == "max":
-                            return max(vals)
-                        else:
-                            return min(vals)
-
-                    else:
-                        skips -= 1
-
-        else:
+        df = self.df_orders
 
-            # Iterate through orders in the geodata dict
-            for feature in self.geodata['features']:
+        for column in self.category_columns:
+            df[column] = df[column].astype("category")
 
-                # Find the feature for the given order
-                if feature["properties"]["external_i"] == order:
+        # Flags may come from the layer as numbers or as Y/N or true/false text
+        for column in self.bool_columns:
+            text = df[column].astype("string").str.strip().str.lower()
+            df[column] = text.map({"1": True, "1.0": True, "y": True, "yes": True, "t": True, "true": True,
+                                   "0": False, "0.0": False, "n": False, "no": False, "f": False, "false": False}).astype("boolean")
 
-                    if direction == "x":
-                        vals = [i for i, j in feature['geometry']['coordinates'][0]]
-                    else:
-                        vals = [j for i, j in feature['geometry']['coordinates'][0]]
+        for column in ["x_max", "x_min", "y_max", "y_min"]:
+            df[column] = df[column].astype("float64")
 
-                    if value == "max":
-                        return max(vals)
-                    else:
-                        return min(vals)
+        # Kilometer dimensions do not need double precision
+        for column in ["width", "height"]:
+            df[column] = df[column].astype("float32")
 
-        return "Not found"
+    def populate_geodata(self):
+        """ Creates and populates the geodata fields for the orders dataframe """
 
-    def populate_dimensions(self):
-        """ Creates and populates the width and height fields for the orders dataframe """
+        # Build the bounding box index once from the geojson features and join it onto the orders
+        bboxes = join_bboxes(self.df_orders.external_i, self.build_geodata_index())
 
-        # Apply the calculated width to each row 
-        self.df_orders["width"] = self.df_orders.apply(lambda p: self.get_distance((p.y_min, p.x_min), (p.y_min, p.x_max)), axis=1)
+        for column in ["x_max", "x_min", "y_max", "y_min"]:
+            self.df_orders[column] = bboxes[column].values
 
+    def build_geodata_index(self):
+        """ Returns a dataframe of the bounding box of each geojson feature keyed on (external_i, part_index) """
 
-    def get_distance(self, a, b):
-        """ Returns the distance between two points given at tuple of (lat, lon) of each """
+        return bbox_index(self.geodata_path)
 
-        lat1, lon1 = a
-        lat2, lon2 = b
+    def populate_dimensions(self):
+        """ Creates and populates the width and height fields for the orders dataframe """
 
-        return acos(sin(lat1)*sin(lat2)+cos(lat1)*cos(lat2)*cos(lon2-lon1))*6371
+        self.df_orders["width"], self.df_orders["height"] = bbox_dimensions(self.df_orders)
 
-    def output_df_to_csv(self):
-        """ Creates a .csv file with the data from the orders dataframe """
+    def output_df(self, output_format="csv", partition_cols=None):
+        """ Writes the display columns of the orders dataframe as a "csv", "parquet" or "feather" file,
+        parquet output can be partitioned by "rev" and "date" """
 
         # Create a timestamp string
         timestamp = str(datetime.now())[:19]
@@ -219,11 +201,26 @@ class Orders:
                     "y_min",
                     "width",
                     "height"]
-        
-        # Creates a .csv file from the dataframe of all changes needed
-        self.df_orders.loc[:, display_columns].to_csv(self.output_path + "\\" + "_" + timestamp + " Table.csv")
 
+        df = self.df_orders.loc[:, display_columns]
+        os.makedirs(self.output_path, exist_ok=True)
+
+        if output_format == "csv":
+
+            # Creates a .csv file from the dataframe of all changes needed
+            df.to_csv(os.path.join(self.output_path, "_" + timestamp + " Table.csv"))
 
-        
+        elif output_format == "feather":
+            df.reset_index(drop=True).to_feather(os.path.join(self.output_path, "_" + timestamp + " Table.feather"))
 
+        elif output_format == "parquet":
 
+            # A partitioned dataset is written to one folder that each run adds its partition to
+            if partition_cols:
+                df = df.assign(rev=str(self.rev), date=timestamp[:10])
+                df.to_parquet(os.path.join(self.output_path, "Table.parquet"), partition_cols=partition_cols, index=False)
+            else:
+                df.to_parquet(os.path.join(self.output_path, "_" + timestamp + " Table.parquet"), index=False)
+
+        else:
+            raise Exception(f"Unknown output format '{output_format}'.")
@@ -0,0 +1,86 @@
+# Author: Casey Betts, 2024
+# Persistent catalog of the per rev slices of an ONV layer written in one sorted pass
+
+import json
+import os
+
+
+class RevCatalog:
+    """ Records, for each rev slice of the ONV, its output, feature count, bounding box and the offsets of its
+    ONA bands
+
+    Slices are written sorted by days then ona, so every (days, ona) band is a run of consecutive features and
+    the feature at offset i of a slice has object id i + 1 in a new feature class.
+    """
+
+    def __init__(self, path):
+
+        self.path = path
+
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def start(self, rev, output, source=None):
+        """ Starts a new slice for the rev, replacing any earlier one """
+
+        self.entries[str(rev)] = {"output": output, "source": source, "count": 0, "bbox": None, "bands": []}
+
+    def add(self, rev, days, ona, bounds=None):
+        """ Records the next feature of the rev's slice given its days, ona and (x_min, y_min, x_max, y_max) """
+
+        entry = self.entries[str(rev)]
+        bands = entry["bands"]
+
+        # Extend the current band or start the next one
+        if bands and bands[-1]["days"] == days and bands[-1]["ona"] == ona:
+            band = bands[-1]
+        else:
+            band = {"days": days, "ona": ona, "offset": entry["count"], "count": 0, "bbox": None}
+            bands.append(band)
+
+        band["count"] += 1
+        entry["count"] += 1
+
+        if bounds is not None:
+            band["bbox"] = union_bounds(band["bbox"], bounds)
+            entry["bbox"] = union_bounds(entry["bbox"], bounds)
+
+    def revs(self):
+        """ Returns the revs in the catalog """
+
+        return list(self.entries)
+
+    def output(self, rev):
+        """ Returns the feature class holding the rev's slice """
+
+        return self.entries[str(rev)]["output"]
+
+    def bands(self, rev, days=None, onas=None):
+        """ Returns the bands of the rev, only those of the given days and onas if given """
+
+        return [band for band in self.entries[str(rev)]["bands"]
+                if (days is None or band["days"] == days) and (onas is None or band["ona"] in onas)]
+
+    def where(self, rev, days=None, onas=None, oid_field="OBJECTID"):
+        """ Returns a where clause selecting the given bands of the rev's slice by object id """
+
+        ranges = [f"({oid_field} > {band['offset']} And {oid_field} <= {band['offset'] + band['count']})"
+                  for band in self.bands(rev, days, onas)]
+
+        return " Or ".join(ranges) or "1 = 0"
+
+    def save(self):
+        """ Writes the catalog to its json file """
+
+        with open(self.path, "w") as f:
+            json.dump(self.entries, f, indent=1)
+
+def union_bounds(a, b):
+    """ Returns the bounding box covering two (x_min, y_min, x_max, y_max) boxes, either of which may be None """
+
+    if a is None:
+        return list(b)
+
+    return [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
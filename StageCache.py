@@ -0,0 +1,107 @@
+# Author: Casey Betts, 2024
+# Content addressed cache of pipeline stage outputs keyed on a hash of each stage's inputs
+
+import hashlib
+import json
+import os
+
+from time import time
+
+
+def fingerprint(*parts):
+    """ Returns a hex digest of the given json serializable parts """
+
+    text = json.dumps(parts, sort_keys=True, default=str)
+
+    return hashlib.sha256(text.encode()).hexdigest()
+
+def file_fingerprint(path, content=False):
+    """ Returns a fingerprint of a file from its size and modification time, or its full content if asked """
+
+    if content:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    stat = os.stat(path)
+
+    return fingerprint(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+def rows_fingerprint(rows):
+    """ Returns a hex digest of every value of the given rows, bytes (such as WKB geometry) hashed as they are """
+
+    digest = hashlib.sha256()
+
+    for row in rows:
+        for value in row:
+            digest.update(bytes(value) if isinstance(value, (bytes, bytearray, memoryview)) else repr(value).encode())
+            digest.update(b"\x1f")
+        digest.update(b"\x1e")
+
+    return digest.hexdigest()
+
+
+class StageCache:
+    """ Skips pipeline stages whose inputs have not changed since their outputs were last written
+
+    Each stage's key is a hash of its inputs, and a stage's key is passed on as an input of the stages that
+    use its outputs, so changing one input only reruns the stages downstream of it. The catalog of keys is
+    kept in a json file and the least recently used outputs are deleted once more than max_entries stages
+    are stored.
+    """
+
+    def __init__(self, catalog_path, exists, delete, max_entries=64, log=print):
+
+        self.catalog_path = catalog_path
+        self.exists = exists
+        self.delete = delete
+        self.max_entries = max_entries
+        self.log = log
+
+        self.catalog = {}
+        if os.path.exists(catalog_path):
+            with open(catalog_path) as f:
+                self.catalog = json.load(f)
+
+    def stage(self, name, outputs, inputs, func):
+        """ Runs func() unless the given outputs were already produced from the same inputs, returns the stage key """
+
+        key = fingerprint(name, inputs)
+        entry = self.catalog.get(name)
+
+        if entry and entry["key"] == key and all(self.exists(output) for output in entry["outputs"]):
+            self.log(f"Cache hit: {name}")
+            entry["used"] = time()
+            self.save()
+            return key
+
+        self.log(f"Cache miss: {name}")
+
+        # A stage overwrites its outputs, so the old entry is gone whether or not func succeeds
+        self.catalog.pop(name, None)
+        func()
+
+        self.catalog[name] = {"key": key, "outputs": list(outputs), "used": time()}
+        self.evict()
+        self.save()
+
+        return key
+
+    def evict(self):
+        """ Deletes the outputs of the least recently used stages beyond max_entries """
+
+        stale = sorted(self.catalog, key=lambda name: self.catalog[name]["used"])[:max(0, len(self.catalog) - self.max_entries)]
+
+        for name in stale:
+            for output in self.catalog.pop(name)["outputs"]:
+                if self.exists(output):
+                    self.delete(output)
+            self.log(f"Cache evicted: {name}")
+
+    def save(self):
+        """ Writes the catalog to disk """
+
+        with open(self.catalog_path, "w") as f:
+            json.dump(self.catalog, f, indent=1)
@@ -0,0 +1,107 @@
+# Author: Casey Betts, 2024
+# Generates collection strips along the ground track and ranks them by the clear order value they cover
+#
+# Geometry is worked in a sinusoidal projection centered on the rev, which is equal area, so a strip's
+# value (sum of value per km² times km² of each clear face it covers) is exact; strip shapes are slightly
+# sheared far from the central meridian.
+
+import heapq
+
+import numpy as np
+import shapely
+
+from shapely import STRtree
+
+from Geodesy import EARTH_RADIUS_KM
+
+
+def to_sinusoidal(geometries, lon0):
+    """ Returns the geometries projected from degrees to sinusoidal km centered on the given longitude """
+
+    def forward(coords):
+        lon, lat = np.radians(coords[:, 0] - lon0), np.radians(coords[:, 1])
+        return np.column_stack([EARTH_RADIUS_KM * lon * np.cos(lat), EARTH_RADIUS_KM * lat])
+
+    # Slivers valid in degrees can self-intersect by a rounding error once projected
+    return shapely.make_valid(shapely.transform(geometries, forward))
+
+def from_sinusoidal(geometries, lon0):
+    """ Returns the geometries projected from sinusoidal km centered on the given longitude back to degrees """
+
+    def inverse(coords):
+        lat = coords[:, 1] / EARTH_RADIUS_KM
+        cos_lat = np.maximum(np.cos(lat), 1e-12)
+        return np.column_stack([np.degrees(coords[:, 0] / (EARTH_RADIUS_KM * cos_lat)) + lon0, np.degrees(lat)])
+
+    return shapely.transform(geometries, inverse)
+
+def track_heading(footprint):
+    """ Returns the heading in radians (counter clockwise from the x axis) of the long axis of a projected footprint """
+
+    coords = np.asarray(shapely.minimum_rotated_rectangle(footprint).exterior.coords)
+    edges = np.diff(coords[:3], axis=0)
+    longest = edges[np.argmax(np.hypot(edges[:, 0], edges[:, 1]))]
+
+    return np.arctan2(longest[1], longest[0])
+
+def iter_strips(footprint, heading, width_km=15, length_km=60, batch_size=10000):
+    """ Yields batches of strip polygons tiling the projected footprint, long side along the heading """
+
+    # Tile a grid in the frame rotated to the track and rotate the cells back
+    along = np.array([np.cos(heading), np.sin(heading)])
+    across = np.array([-along[1], along[0]])
+
+    coords = shapely.get_coordinates(footprint)
+    u, v = coords @ along, coords @ across
+    us = np.arange(u.min(), u.max(), length_km)
+    vs = np.arange(v.min(), v.max(), width_km)
+
+    shapely.prepare(footprint)
+    corners = np.array([[0, 0], [length_km, 0], [length_km, width_km], [0, width_km], [0, 0]])
+
+    for start in range(0, len(us) * len(vs), batch_size):
+        cells = np.arange(start, min(start + batch_size, len(us) * len(vs)))
+        origin_u, origin_v = us[cells // len(vs)], vs[cells % len(vs)]
+
+        # (cells, 5 corners, uv) to (cells, 5 corners, xy)
+        uv = np.stack([origin_u[:, None] + corners[:, 0], origin_v[:, None] + corners[:, 1]], axis=-1)
+        xy = uv[..., :1] * along + uv[..., 1:] * across
+
+        strips = shapely.polygons(xy)
+        yield strips[shapely.intersects(footprint, strips)]
+
+def score_strips(strips, tree, faces, values):
+    """ Returns the clear dollar value covered by each strip given a tree of projected faces and their value per km² """
+
+    strip_index, face_index = tree.query(strips, predicate="intersects")
+    areas = shapely.area(shapely.intersection(strips[strip_index], faces[face_index]))
+
+    return np.bincount(strip_index, weights=areas * values[face_index], minlength=len(strips))
+
+def top_strips(faces, values, footprint, k=20, width_km=15, length_km=60):
+    """ Returns the k strips of the rev covering the most clear order value as a list of (value, strip)
+    with the strips in degrees, given the clear order faces and rev footprint in degrees """
+
+    lon0 = shapely.centroid(footprint).x
+    faces = to_sinusoidal(np.asarray(faces, dtype=object), lon0)
+    footprint = to_sinusoidal(footprint, lon0)
+    values = np.asarray(values, dtype="float64")
+
+    tree = STRtree(faces)
+    heading = track_heading(footprint)
+
+    # Keep only the best k strips while scoring a batch at a time
+    heap = []
+    count = 0
+
+    for strips in iter_strips(footprint, heading, width_km, length_km):
+        for value, strip in zip(score_strips(strips, tree, faces, values), strips):
+            count += 1
+            if len(heap) < k:
+                heapq.heappush(heap, (value, count, strip))
+            elif value > heap[0][0]:
+                heapq.heapreplace(heap, (value, count, strip))
+
+    best = sorted(heap, key=lambda item: item[0], reverse=True)
+
+    return [(value, from_sinusoidal(strip, lon0)) for value, _, strip in best]
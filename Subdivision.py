@@ -0,0 +1,131 @@
+# Author: Casey Betts, 2024
+# ArcPro-free engine that cuts polygons into strips of equal area, in place of SubdividePolygon
+#
+# Each polygon is cut in a sinusoidal projection centered on it, which is equal area on the sphere, so
+# strip areas are geodesic km² (the cos(latitude) scale factors come from a table built once). Cuts are
+# placed by bisection until the area before each cut is within tolerance * target of its goal, every
+# strip is then the target area within 2 * tolerance * target except the last one of each polygon, which
+# holds the remainder.
+
+import numpy as np
+import shapely
+
+from Geodesy import EARTH_RADIUS_KM
+
+# Scale factor of the longitude axis for every LAT_STEP degrees of latitude
+LAT_STEP = 1e-3
+COS_LAT = np.cos(np.radians(np.arange(-90, 90 + LAT_STEP / 2, LAT_STEP)))
+
+# Longest edge in degrees before projecting and in km before unprojecting, so edges follow their curved images
+SEGMENT_DEG = 0.02
+SEGMENT_KM = 2.0
+
+
+def cos_lat(lat):
+    """ Returns the cached cosine of the given latitudes in degrees """
+
+    return COS_LAT[np.rint((np.clip(lat, -90, 90) + 90) / LAT_STEP).astype(np.intp)]
+
+def project(geometries, lon0):
+    """ Returns the geometries projected from degrees to sinusoidal km, each centered on its own longitude """
+
+    coords, index = shapely.get_coordinates(geometries, return_index=True)
+    x = EARTH_RADIUS_KM * np.radians(coords[:, 0] - lon0[index]) * cos_lat(coords[:, 1])
+    y = EARTH_RADIUS_KM * np.radians(coords[:, 1])
+
+    return shapely.set_coordinates(geometries.copy(), np.column_stack([x, y]))
+
+def unproject(geometries, lon0):
+    """ Returns the geometries projected from sinusoidal km back to degrees given the longitude of each """
+
+    coords, index = shapely.get_coordinates(geometries, return_index=True)
+    lat = np.degrees(coords[:, 1] / EARTH_RADIUS_KM)
+    lon = np.degrees(coords[:, 0] / (EARTH_RADIUS_KM * np.maximum(cos_lat(lat), 1e-12))) + lon0[index]
+
+    return shapely.set_coordinates(geometries.copy(), np.column_stack([lon, lat]))
+
+def slabs(t_low, t_high, s_low, s_high, advance, along):
+    """ Returns the rectangles between the given offsets across (t) and along (s) the cut lines """
+
+    t = np.stack([t_low, t_high, t_high, t_low, t_low], axis=-1)
+    s = np.stack([s_low, s_low, s_high, s_high, s_low], axis=-1)
+
+    return shapely.polygons(t[..., None] * advance + s[..., None] * along)
+
+def equal_area_cells(geometries, target_km2=50, angle=90, tolerance=1e-3, max_iterations=60):
+    """ Returns (cells in degrees, index of the geometry each came from, cell areas in km²) cutting the given
+    polygons into strips of target_km2 with cut lines at angle degrees counter clockwise from east """
+
+    geometries = np.asarray(geometries, dtype=object)
+    empty = (np.empty(0, dtype=object), np.empty(0, dtype=np.intp), np.empty(0))
+
+    if not len(geometries):
+        return empty
+
+    # Project each polygon around its own center, edges are straight in degrees but not in the projection so they
+    # are densified first
+    bounds = shapely.bounds(geometries)
+    lon0 = (bounds[:, 0] + bounds[:, 2]) / 2
+    shapes = project(shapely.segmentize(geometries, SEGMENT_DEG), lon0)
+    areas = shapely.area(shapes)
+
+    # Offsets of every vertex across (t) and along (s) the cut lines, padded so slabs cover the whole shape
+    along = np.array([np.cos(np.radians(angle)), np.sin(np.radians(angle))])
+    advance = np.array([along[1], -along[0]])
+
+    coords, index = shapely.get_coordinates(shapes, return_index=True)
+    t, s = coords @ advance, coords @ along
+    t_min, t_max, s_min, s_max = (np.full(len(shapes), fill) for fill in (np.inf, -np.inf, np.inf, -np.inf))
+    np.minimum.at(t_min, index, t)
+    np.maximum.at(t_max, index, t)
+    np.minimum.at(s_min, index, s)
+    np.maximum.at(s_max, index, s)
+    t_min, t_max, s_min, s_max = t_min - 1, t_max + 1, s_min - 1, s_max + 1
+
+    # One cut per whole target area, a remainder within tolerance is not worth a strip of its own
+    n_cells = np.maximum(1, np.ceil(areas / target_km2 - tolerance)).astype(np.intp)
+    owner = np.repeat(np.arange(len(shapes)), n_cells - 1)
+    goal = (np.arange(len(owner)) - (np.cumsum(n_cells - 1) - (n_cells - 1))[owner] + 1) * target_km2
+
+    # Bisect every cut of the batch at once, dropping the cuts as they converge
+    low, high = t_min[owner], t_max[owner]
+    cuts = (low + high) / 2
+    active = np.arange(len(owner))
+
+    for _ in range(max_iterations):
+        if not len(active):
+            break
+
+        cuts[active] = (low[active] + high[active]) / 2
+        i = owner[active]
+        before = shapely.area(shapely.intersection(shapes[i], slabs(t_min[i], cuts[active], s_min[i], s_max[i], advance, along)))
+
+        short = before < goal[active]
+        low[active] = np.where(short, cuts[active], low[active])
+        high[active] = np.where(short, high[active], cuts[active])
+
+        active = active[np.abs(before - goal[active]) > tolerance * target_km2]
+
+    # Strips between consecutive cuts, from the start of the shape to the first cut and the last cut to its end
+    cell_owner = np.repeat(np.arange(len(shapes)), n_cells)
+    position = np.arange(len(cell_owner)) - (np.cumsum(n_cells) - n_cells)[cell_owner]
+    cut = (np.cumsum(n_cells - 1) - (n_cells - 1))[cell_owner] + position
+    padded = np.append(cuts, 0.0)
+
+    t_low = np.where(position == 0, t_min[cell_owner], padded[np.maximum(cut - 1, 0)])
+    t_high = np.where(position == n_cells[cell_owner] - 1, t_max[cell_owner], padded[np.minimum(cut, len(cuts))])
+
+    cells = shapely.intersection(shapes[cell_owner], slabs(t_low, t_high, s_min[cell_owner], s_max[cell_owner], advance, along))
+
+    # A slab edge running along a polygon edge can leave line work in a collection
+    for i in np.flatnonzero(shapely.get_type_id(cells) == 7):
+        parts = shapely.get_parts(cells[i])
+        cells[i] = shapely.union_all(parts[shapely.get_type_id(parts) == 3])
+
+    keep = ~shapely.is_empty(cells) & (shapely.area(cells) > 0)
+
+    if not keep.any():
+        return empty
+
+    # Cut lines are straight in the projection, densify them too so the cells in degrees keep their areas
+    return unproject(shapely.segmentize(cells[keep], SEGMENT_KM), lon0[cell_owner[keep]]), cell_owner[keep], shapely.area(cells[keep])
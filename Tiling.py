@@ -0,0 +1,79 @@
+# Author: Casey Betts, 2024
+# Splits a rev into along track tiles and runs the order overlay on the tiles in parallel
+#
+# Each tile gets every order intersecting it clipped to the tile, so the sum at any point of a tile is the sum
+# of all orders covering that point, exactly as in the untiled overlay. Tiles only share edges, so faces cut
+# by a seam keep the same value on both sides and their areas add up to the untiled face's area.
+
+import numpy as np
+import shapely
+
+from concurrent.futures import ProcessPoolExecutor
+from shapely import STRtree
+
+from OrderOverlay import polygon_parts, sum_overlay
+from StripRanking import track_heading
+
+
+def along_track_tiles(geometries, footprint, n_tiles):
+    """ Returns n_tiles polygons covering the footprint, cut across the track so each holds about as many orders """
+
+    heading = track_heading(footprint)
+    along = np.array([np.cos(heading), np.sin(heading)])
+    across = np.array([-along[1], along[0]])
+
+    # Tiles have to reach past the footprint to hold the whole of every order
+    corners = shapely.bounds(geometries).reshape(-1, 4)[:, [[0, 1], [0, 3], [2, 1], [2, 3]]].reshape(-1, 2)
+    coords = np.concatenate([shapely.get_coordinates(footprint), corners])
+
+    # Cut where the orders' centers split evenly along the track
+    centers = shapely.get_coordinates(shapely.centroid(geometries)) if len(geometries) else coords
+    u = coords @ along
+    cuts = np.quantile(centers @ along, np.linspace(0, 1, n_tiles + 1)[1:-1]) if n_tiles > 1 else np.empty(0)
+    edges = np.concatenate([[u.min() - 1], cuts, [u.max() + 1]])
+
+    v = coords @ across
+    v_min, v_max = v.min() - 1, v.max() + 1
+
+    # Slabs between consecutive cuts spanning the whole width of the footprint
+    tiles = []
+    for u0, u1 in zip(edges[:-1], edges[1:]):
+        corners = np.array([[u0, v_min], [u1, v_min], [u1, v_max], [u0, v_max], [u0, v_min]])
+        tiles.append(shapely.polygons(corners[:, :1] * along + corners[:, 1:] * across))
+
+    return np.array(tiles, dtype=object)
+
+def overlay_tile(tile_wkb, order_wkbs, values):
+    """ Returns the overlay faces (as WKB), summed values and join counts of the given orders inside one tile """
+
+    tile = shapely.from_wkb(tile_wkb)
+
+    # Only the part of each order inside the tile, cutting can leave lines and points that are dropped
+    clipped, index = polygon_parts(shapely.intersection(shapely.from_wkb(order_wkbs), tile))
+    faces, sums, counts = sum_overlay(clipped, np.asarray(values, dtype="float64")[index])
+
+    return shapely.to_wkb(faces), sums, counts
+
+def tiled_sum_overlay(geometries, values, footprint, n_tiles=8, workers=None):
+    """ Returns (faces, summed values, join counts, tile index) of the order overlay computed tile by tile in a
+    process pool, each worker only holding its tile's orders """
+
+    geometries = np.asarray(geometries, dtype=object)
+    values = np.asarray(values, dtype="float64")
+
+    tiles = along_track_tiles(geometries, footprint, n_tiles)
+    tile_index, order_index = STRtree(geometries).query(tiles, predicate="intersects")
+
+    wkbs = shapely.to_wkb(geometries)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(overlay_tile, shapely.to_wkb(tile), wkbs[order_index[tile_index == t]], values[order_index[tile_index == t]])
+                   for t, tile in enumerate(tiles)]
+        results = [future.result() for future in futures]
+
+    faces = np.concatenate([shapely.from_wkb(faces) for faces, _, _ in results])
+    sums = np.concatenate([sums for _, sums, _ in results])
+    counts = np.concatenate([counts for _, _, counts in results])
+    tile = np.concatenate([np.full(len(sums), t) for t, (_, sums, _) in enumerate(results)])
+
+    return faces, sums, counts, tile
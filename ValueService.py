@@ -0,0 +1,223 @@
+# Author: Casey Betts, 2024
+# In-memory query service over the clear order value surfaces of the loaded revs
+#
+# Each rev is held in a sinusoidal projection centered on it (see StripRanking) so dollar values are
+# value per km² times exact km². Requests are newline delimited JSON over TCP or a Unix socket, one reply
+# line per request, and every request scores a whole batch of geometries given as WKT in degrees:
+#
+#   {"op": "footprint_value", "revs": ["12345"], "geometries": ["POLYGON (...)", ...]}
+#   {"op": "top_orders", "rev": "12345", "geometries": ["POLYGON (...)", ...], "k": 10}
+#   {"op": "revs"}
+
+import asyncio
+import json
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import shapely
+
+from shapely import STRtree
+
+from StripRanking import score_strips, to_sinusoidal
+
+
+class RevIndex:
+    """ Spatial index of one rev's clear faces and the orders they came from """
+
+    def __init__(self, rev, faces, values, orders, order_values, order_ids, version=None):
+
+        self.rev = rev
+        self.version = version
+
+        # Project around the middle of the rev so areas are in km²
+        faces = np.asarray(faces, dtype=object)
+        self.lon0 = float(np.mean(shapely.get_coordinates(faces)[:, 0])) if len(faces) else 0.0
+
+        self.faces = to_sinusoidal(faces, self.lon0)
+        self.values = np.asarray(values, dtype="float64")
+        self.orders = to_sinusoidal(np.asarray(orders, dtype=object), self.lon0)
+        self.order_values = np.asarray(order_values, dtype="float64")
+        self.order_ids = np.asarray(order_ids, dtype=object)
+
+        self.tree = STRtree(self.faces)
+        self.order_tree = STRtree(self.orders)
+
+    def project(self, geometries):
+        """ Returns the given geometries in degrees projected to the rev's frame """
+
+        return to_sinusoidal(np.asarray(geometries, dtype=object), self.lon0)
+
+    def footprint_values(self, geometries):
+        """ Returns the clear dollar value inside each of the given footprints """
+
+        return score_strips(self.project(geometries), self.tree, self.faces, self.values)
+
+    def top_orders(self, geometries, k=10):
+        """ Returns for each of the given strips the k orders with the most clear dollar value under it, as lists
+        of (order id, value) """
+
+        strips = self.project(geometries)
+
+        # Clip the faces to the strips, a face lies wholly inside or outside every order
+        strip_index, face_index = self.tree.query(strips, predicate="intersects")
+        pieces = shapely.intersection(strips[strip_index], self.faces[face_index])
+        areas = shapely.area(pieces)
+
+        # Credit each piece's area to the orders containing it
+        piece_index, order_index = self.order_tree.query(shapely.point_on_surface(pieces), predicate="within")
+        keep = areas[piece_index] > 0
+        piece_index, order_index = piece_index[keep], order_index[keep]
+
+        pairs, inverse = np.unique(np.column_stack([strip_index[piece_index], order_index]), axis=0, return_inverse=True)
+        totals = np.bincount(inverse.ravel(), weights=areas[piece_index] * self.order_values[order_index], minlength=len(pairs))
+
+        # Best first within each strip
+        ranked = np.lexsort((-totals, pairs[:, 0]))
+        results = [[] for _ in range(len(strips))]
+
+        for strip, order, total in zip(pairs[ranked, 0], pairs[ranked, 1], totals[ranked]):
+            if len(results[strip]) < k:
+                results[strip].append((self.order_ids[order], float(total)))
+
+        return results
+
+class ValueService:
+    """ Holds a RevIndex per rev, reloading a rev whenever its version changes
+
+    load(rev) returns (faces, values, orders, order_values, order_ids), version(rev) returns a token that changes
+    when the rev's layers are rewritten and list_revs() the revs available, all three may block """
+
+    def __init__(self, load, version, list_revs, revs=None, poll_seconds=30, log=print):
+
+        self.load = load
+        self.version = version
+        self.list_revs = list_revs
+        self.revs = None if revs is None else [str(rev) for rev in revs]
+        self.poll_seconds = poll_seconds
+        self.log = log
+        self.indexes = {}
+
+        # Loads are run one at a time off the event loop, the readers need not be thread safe
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def build(self, rev):
+        """ Loads and indexes a rev, returns None if it has not changed since it was loaded """
+
+        version = self.version(rev)
+        current = self.indexes.get(rev)
+
+        if current is not None and current.version == version:
+            return None
+
+        start = time.perf_counter()
+        index = RevIndex(rev, *self.load(rev), version=version)
+        self.log(f"Indexed rev {rev}: {len(index.faces)} faces, {len(index.orders)} orders in {time.perf_counter() - start:.2f}s")
+
+        return index
+
+    async def reload(self):
+        """ Indexes new revs and re-indexes changed ones, queries keep using the old index until the swap """
+
+        loop = asyncio.get_running_loop()
+        revs = self.revs if self.revs is not None else await loop.run_in_executor(self.executor, self.list_revs)
+
+        for rev in revs:
+            try:
+                index = await loop.run_in_executor(self.executor, self.build, rev)
+            except Exception as error:
+                self.log(f"Failed to index rev {rev}: {error}")
+                continue
+
+            if index is not None:
+                self.indexes[rev] = index
+
+    async def watch(self):
+        """ Reloads the revs every poll_seconds """
+
+        while True:
+            await asyncio.sleep(self.poll_seconds)
+            await self.reload()
+
+    def index(self, rev):
+        """ Returns the index of a loaded rev """
+
+        try:
+            return self.indexes[str(rev)]
+        except KeyError:
+            raise KeyError(f"rev {rev} is not loaded") from None
+
+    def handle(self, request):
+        """ Returns the reply to one decoded request """
+
+        op = request.get("op")
+
+        if op == "revs":
+            return {"revs": {rev: index.version for rev, index in self.indexes.items()}}
+
+        geometries = shapely.from_wkt(request.get("geometries", []))
+
+        if op == "footprint_value":
+            revs = request.get("revs") or list(self.indexes)
+            values = sum((self.index(rev).footprint_values(geometries) for rev in revs), np.zeros(len(geometries)))
+            return {"values": values.tolist()}
+
+        if op == "top_orders":
+            orders = self.index(request["rev"]).top_orders(geometries, int(request.get("k", 10)))
+            return {"orders": [[[str(order), value] for order, value in strip] for strip in orders]}
+
+        raise ValueError(f"unknown op {op!r}")
+
+    async def connection(self, reader, writer):
+        """ Answers the requests of one client until it disconnects """
+
+        try:
+            while line := await reader.readline():
+                try:
+                    reply = self.handle(json.loads(line))
+                except Exception as error:
+                    reply = {"error": str(error)}
+
+                writer.write(json.dumps(reply).encode() + b"\n")
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=8765, path=None):
+        """ Loads the revs and serves requests on a TCP port, or on a Unix socket if a path is given """
+
+        await self.reload()
+
+        if path is not None:
+            server = await asyncio.start_unix_server(self.connection, path)
+        else:
+            server = await asyncio.start_server(self.connection, host, port)
+
+        self.log(f"Serving {len(self.indexes)} revs on {path or f'{host}:{port}'}")
+
+        watcher = asyncio.create_task(self.watch())
+
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            watcher.cancel()
+            self.executor.shutdown(wait=False)
+
+async def query(requests, host="127.0.0.1", port=8765, path=None):
+    """ Sends the given requests to a running service and returns the replies """
+
+    if path is not None:
+        reader, writer = await asyncio.open_unix_connection(path)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+
+    try:
+        # Pipeline every request before reading the replies
+        writer.writelines(json.dumps(request).encode() + b"\n" for request in requests)
+        await writer.drain()
+
+        return [json.loads(await reader.readline()) for _ in requests]
+    finally:
+        writer.close()
@@ -0,0 +1,67 @@
+# Author: Casey Betts, 2024
+# Evaluates clear order value for a stack of weather rasters (hourly analyses or ensemble members) at once
+
+import numpy as np
+import pandas as pd
+
+
+def build_stack(path, grid, slices, count=None, nodata=0):
+    """ Writes the cloudy pixels (other than nodata) of the weather slices into a memory mapped boolean
+    (time, rows, cols) .npy file on the grid and returns it
+
+    slices is an iterable of count 2-D arrays already on the common grid; a generator reading the rasters one at
+    a time keeps only one slice in memory besides the memory map. Only cloudy or clear is kept, so weather values
+    of any type and range fit in one byte per pixel.
+    """
+
+    count = len(slices) if count is None else count
+    stack = np.lib.format.open_memmap(path, mode="w+", dtype="bool", shape=(count, grid.rows, grid.cols))
+
+    for t, weather in enumerate(slices):
+        stack[t] = np.asarray(weather) != nodata
+
+    stack.flush()
+
+    return stack
+
+def open_stack(path):
+    """ Returns a read only memory map of a stack written by build_stack """
+
+    return np.load(path, mmap_mode="r")
+
+def clear_value_over_time(value_surface, stack, chunk_rows=256):
+    """ Returns an array of the clear dollar value of the value surface under each time slice of the stack
+
+    value_surface is the dollar value on each pixel (see ClearValueRaster.burn_values), computed once and reused
+    for every slice. The stack is read a band of rows at a time so memory stays bounded.
+    """
+
+    totals = np.zeros(stack.shape[0])
+
+    for r0 in range(0, stack.shape[1], chunk_rows):
+        values = value_surface[r0:r0 + chunk_rows]
+
+        # Skip bands of the surface without any order value
+        if not values.any():
+            continue
+
+        clear = ~np.asarray(stack[:, r0:r0 + chunk_rows])
+        totals += np.einsum("trc,rc->t", clear, values, dtype="float64")
+
+    return totals
+
+def value_over_time(value_surface, stack, labels=None, rev=None):
+    """ Returns a table of the clear value, total value and clear fraction of the rev for each time slice """
+
+    clear = clear_value_over_time(value_surface, stack)
+    total = float(np.sum(value_surface, dtype="float64"))
+
+    table = pd.DataFrame({"slice": labels if labels is not None else range(len(clear)),
+                          "clear_value": clear,
+                          "total_value": total,
+                          "clear_fraction": clear / total if total else np.nan})
+
+    if rev is not None:
+        table.insert(0, "rev", rev)
+
+    return table
@@ -0,0 +1,14 @@
+# Author: Casey Betts, 2024
+# Lets the tests import the tool modules from the repository root without ArcPro installed
+
+import os
+import sys
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Tests only exercise the ArcPro-free parts of the modules, arcpy calls fail loudly if one is reached
+try:
+    import arcpy
+except ImportError:
+    sys.modules["arcpy"] = types.ModuleType("arcpy")
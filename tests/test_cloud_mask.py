@@ -0,0 +1,22 @@
+import warnings
+
+import numpy as np
+import shapely
+
+from ClearValueRaster import Grid
+from CloudMask import polygon_runs
+
+
+def test_rows_between_parts_make_no_runs():
+    grid = Grid(0, 10, 1, 1, 10, 10)
+
+    # The rows between the two parts cut nothing and leave empty pieces
+    order = shapely.MultiPolygon([shapely.box(1, 1, 4, 3.2), shapely.box(5, 6.8, 8, 9)])
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        owner, rows, starts, stops = polygon_runs(np.array([order], dtype=object), grid)
+
+    assert rows.tolist() == [1, 2, 7, 8]
+    assert starts.tolist() == [5, 5, 1, 1]
+    assert stops.tolist() == [8, 8, 4, 4]
@@ -0,0 +1,96 @@
+# Author: Casey Betts, 2024
+# Regression test of the Orders bounding box columns against the original per row GeoJSON scan
+
+import json
+
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+from Geodesy import get_distance
+from Orders import Orders
+
+
+def legacy_geodata(geodata, df_orders, direction, value):
+    """ The original populate_geodata / get_geodata pass for one column, kept as the reference """
+
+    counts = Counter(df_orders.external_i).items()
+    duplicates = [order for order, count in counts if count > 1]
+    count_dict = dict(counts)
+
+    def get_geodata(order):
+
+        if order in duplicates:
+            count_dict[order] -= 1
+            skips = count_dict[order]
+
+            for feature in geodata["features"]:
+                if feature["properties"]["external_i"] == order:
+                    if skips == 0:
+                        vals = [i if direction == "x" else j for i, j in feature["geometry"]["coordinates"][0]]
+                        return max(vals) if value == "max" else min(vals)
+                    skips -= 1
+
+        else:
+            for feature in geodata["features"]:
+                if feature["properties"]["external_i"] == order:
+                    vals = [i if direction == "x" else j for i, j in feature["geometry"]["coordinates"][0]]
+                    return max(vals) if value == "max" else min(vals)
+
+        return "Not found"
+
+    return df_orders.apply(lambda x: get_geodata(x.external_i), axis=1)
+
+def synthetic_deck(tmp_path, n=300, seed=0):
+    """ Writes a geojson export of n orders, some split into several parts, shuffled, and returns the matching
+    rows of the layer in a different order """
+
+    rng = np.random.default_rng(seed)
+    orders = [f"ORD{i:05d}" for i in range(n)]
+    parts = rng.choice([1, 1, 1, 2, 3], n)
+
+    features = []
+    for order, count in zip(orders, parts):
+        for _ in range(count):
+            x, y = rng.uniform(-179, 178), rng.uniform(-80, 79)
+            w, h = rng.uniform(0.01, 1, 2)
+            ring = [[x, y], [x + w, y], [x + w, y + h], [x, y + h], [x, y]]
+            features.append({"type": "Feature", "properties": {"external_i": order, "other": 1},
+                             "geometry": {"type": "Polygon", "coordinates": [ring]}})
+
+    features = [features[i] for i in rng.permutation(len(features))]
+    geodata = {"type": "FeatureCollection", "features": features}
+
+    path = tmp_path / "out.geojson"
+    path.write_text(json.dumps(geodata))
+
+    # The layer lists the same parts (one row each) in its own order
+    rows = [feature["properties"]["external_i"] for feature in features]
+    df = pd.DataFrame({"external_i": [rows[i] for i in rng.permutation(len(rows))]})
+
+    return geodata, str(path), df
+
+def test_bounding_boxes_match_legacy(tmp_path):
+
+    geodata, path, df = synthetic_deck(tmp_path)
+
+    orders = Orders.__new__(Orders)
+    orders.geodata_path = path
+    orders.df_orders = df.copy()
+    orders.add_columns()
+    orders.populate_geodata()
+    orders.populate_dimensions()
+
+    for direction in ["x", "y"]:
+        for value in ["max", "min"]:
+            column = direction + "_" + value
+            expected = legacy_geodata(geodata, df, direction, value).astype("float64").values
+            np.testing.assert_array_equal(orders.df_orders[column].values, expected, err_msg=column)
+
+    # Dimensions are the haversine distances along the bounding box edges
+    result = orders.df_orders
+    width = [get_distance((y, x0), (y, x1)) for y, x0, x1 in zip(result.y_min, result.x_min, result.x_max)]
+    height = [get_distance((y0, x), (y1, x)) for y0, y1, x in zip(result.y_min, result.y_max, result.x_min)]
+    np.testing.assert_allclose(result.width, width, rtol=1e-9)
+    np.testing.assert_allclose(result.height, height, rtol=1e-9)
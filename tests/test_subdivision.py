@@ -0,0 +1,19 @@
+import numpy as np
+import pytest
+import shapely
+
+from Geodesy import polygon_areas
+from Subdivision import equal_area_cells
+
+
+@pytest.mark.parametrize("angle", [0, 30, 90])
+def test_large_order_cells_keep_their_area(angle):
+    # About 23,000 km² near 60°N, large enough that edges bend in the sinusoidal projection
+    order = shapely.Polygon([(20, 59.5), (23, 60), (22.5, 61.2), (19.8, 60.8)])
+
+    cells, owner, km2 = equal_area_cells([order], target_km2=50, angle=angle, tolerance=1e-3)
+    areas = polygon_areas(cells)
+
+    # Every cell but the remainder is the target within 2 * tolerance * target, measured on the sphere in degrees
+    assert np.all(np.abs(areas[:-1] - 50) <= 2 * 1e-3 * 50 + 1e-3)
+    assert areas.sum() == pytest.approx(polygon_areas([shapely.segmentize(order, 0.001)])[0], rel=1e-4)
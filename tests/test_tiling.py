@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+import shapely
+
+from OrderOverlay import sum_overlay
+from Tiling import tiled_sum_overlay
+
+
+def circle_orders(seed, n=300):
+    """ Returns n overlapping many sided orders and their values, the kind whose clipped edges meet at tile seams """
+
+    rng = np.random.default_rng(seed)
+    centers = rng.uniform(0, 3, (n, 2)) + [170.123456789, 50.987654321]
+    orders = shapely.buffer(shapely.points(centers), rng.uniform(0.01, 0.3, n), quad_segs=int(rng.integers(2, 16)))
+
+    return orders, rng.uniform(1, 100, n)
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_tiled_overlay_matches_untiled(seed):
+    orders, values = circle_orders(seed)
+    footprint = shapely.convex_hull(shapely.union_all(orders))
+
+    faces, sums, _ = sum_overlay(orders, values)
+    tiled_faces, tiled_sums, _, _ = tiled_sum_overlay(orders, values, footprint, n_tiles=8, workers=2)
+
+    area, tiled_area = shapely.area(faces), shapely.area(tiled_faces)
+
+    # No face may be lost along a seam, in area or in value
+    assert tiled_area.sum() == pytest.approx(shapely.area(shapely.union_all(orders)), rel=1e-8)
+    assert tiled_area.sum() == pytest.approx(area.sum(), rel=1e-8)
+    assert (tiled_area * tiled_sums).sum() == pytest.approx((area * sums).sum(), rel=1e-8)